@@ -0,0 +1,262 @@
+import argparse
+import datetime
+import http.client
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+"""
+Generator obciążenia i zestaw testów wydajności serwera (server.py).
+
+Skrypt uruchamia server.py w katalogu tymczasowym (pusta baza danych, własny server.key) na wolnym porcie,
+rejestruje --patients pacjentów z --measurements pomiarami każdy, a następnie dla każdego scenariusza wysyła
+--requests zapytań z --concurrency wątków (każdy wątek korzysta z jednego połączenia trwałego) i wypisuje
+przepustowość oraz percentyle p50/p95/p99 czasu odpowiedzi:
+
+    > login - POST /login z username i password (validate_user; klucz wyprowadzony z hasła przy pierwszym
+      logowaniu pacjenta serwer przechowuje w encryption.fernet_cache)
+    > login-cold - jak login, ale na osobno uruchomionym serwerze z --fernet-cache-size 0, więc każde logowanie
+      wyprowadza klucz z hasła (koszt KDF, pomiary pacjentów nie są wprowadzane)
+    > get - GET /patient z tokenem sesji, ostatnie --get-limit pomiarów (powtarzane zapytania serwer obsługuje
+      z pamięci podręcznej odpowiedzi, database.response_cache)
+    > get-cold - jak get, ale na osobno uruchomionym serwerze z --response-cache-mb 0, więc każde zapytanie
+      odczytuje i odszyfrowuje pomiary z bazy danych
+    > post - POST /patient, pojedynczy pomiar temperatury
+    > bulk - POST /patient, pressure_batch z --batch-size pomiarami
+
+    python benchmark.py [--patients N] [--measurements M] [--requests R] [--concurrency C] [--scenario NAZWA ...]
+                        [--server-arg=--workers=16 ...] [--json WYNIKI.json]
+
+Opcja --json zapisuje wyniki do pliku, aby porównać je z wynikami wcześniejszej wersji serwera.
+"""
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+SERVER_START_TIMEOUT = 60.0  # seconds
+SCENARIOS = ('login', 'login-cold', 'get', 'get-cold', 'post', 'bulk')
+# server.py arguments of the scenarios run against a separate server without the cache the warm scenario hits
+COLD_SERVER_ARGS = {'login-cold': ['--fernet-cache-size=0'],  # every login derives the key from the password
+                    'get-cold': ['--response-cache-mb=0']}  # every GET reads the measurements from the database
+
+
+def free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as probe:
+        probe.bind(('localhost', 0))
+        return probe.getsockname()[1]
+
+
+def start_server(directory: str, port: int, server_args: list):
+    """Runs server.py in `directory` (its database and keys are created there) and waits until it accepts."""
+    process = subprocess.Popen([sys.executable, SERVER_SCRIPT, '--port', str(port), *server_args], cwd=directory,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"server.py exited with code {process.returncode}")
+        try:
+            socket.create_connection(('localhost', port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError(f"server.py didn't start within {SERVER_START_TIMEOUT} s")
+
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+def request(connection, method: str, url: str, body: str = '', headers: dict = None):
+    """(status, body) of one request on a persistent connection."""
+    connection.request(method, url, body=body.encode(), headers=headers or {})
+    response = connection.getresponse()
+    return response.status, response.read()
+
+
+def measurement_entries(count: int, kind: str = 'pressure') -> list:
+    """Random measurements from the last year, in the request body format of pressure / temperature entries."""
+    now = datetime.datetime.now()
+    entries = []
+    for _ in range(count):
+        acquisition = (now - datetime.timedelta(minutes=random.randint(60, 365 * 24 * 60))).strftime('%Y/%m/%d/%H/%M')
+        if kind == 'pressure':
+            entries.append({'systolic': str(round(random.uniform(100, 160), 1)),
+                            'diastolic': str(round(random.uniform(60, 100), 1)),
+                            'acquisition': acquisition})
+        else:
+            entries.append({'value': str(round(random.uniform(36, 40), 1)), 'acquisition': acquisition})
+    return entries
+
+
+def seed(port: int, patients: int, measurements: int, batch_size: int) -> list:
+    """Registers the patients and inserts their measurements, returns [{'username', 'password', 'token'}]."""
+    connection = http.client.HTTPConnection('localhost', port)
+    accounts = []
+    for number in range(patients):
+        account = {'username': f'bench{number}', 'password': f'secret{number}'}
+        credentials = f"username={account['username']}&password={account['password']}"
+        body = json.dumps({'last_name': f'Bench{number}', 'first_name': 'Patient', 'date_of_birth': '1970/01/01'})
+        status, _ = request(connection, 'POST', f'/patient?{credentials}', body, {'entry_type': 'patient'})
+        if status != 200:
+            raise RuntimeError(f"Registration of {account['username']} failed with status {status}")
+
+        status, response = request(connection, 'POST', f'/login?{credentials}')
+        account['token'] = json.loads(response)['token']
+        for start in range(0, measurements, batch_size):
+            entries = measurement_entries(min(batch_size, measurements - start))
+            status, _ = request(connection, 'POST', f'/patient?token={account["token"]}', json.dumps(entries),
+                                {'entry_type': 'pressure_batch'})
+            if status != 200:
+                raise RuntimeError(f"Seeding measurements failed with status {status}")
+        accounts.append(account)
+    connection.close()
+    return accounts
+
+
+def make_request(scenario: str, account: dict, options) -> tuple:
+    """(method, url, body, headers) of one request of the scenario."""
+    authorization = {'Authorization': f"Bearer {account['token']}"}
+    if scenario == 'login' or scenario == 'login-cold':
+        return 'POST', f"/login?username={account['username']}&password={account['password']}", '', {}
+    if scenario == 'get' or scenario == 'get-cold':
+        return 'GET', f'/patient?limit={options.get_limit}', '', authorization
+    if scenario == 'post':
+        body = json.dumps(measurement_entries(1, 'temperature')[0])
+        return 'POST', '/patient', body, {**authorization, 'entry_type': 'temperature'}
+    if scenario == 'bulk':
+        body = json.dumps(measurement_entries(options.batch_size))
+        return 'POST', '/patient', body, {**authorization, 'entry_type': 'pressure_batch'}
+    raise ValueError(f"Unknown scenario: {scenario}")
+
+
+def run_scenario(scenario: str, port: int, accounts: list, options) -> dict:
+    """Sends options.requests requests from options.concurrency threads, returns throughput and latency stats."""
+    latencies = []
+    errors = []
+    results_lock = threading.Lock()
+    counter = iter(range(options.requests))
+    counter_lock = threading.Lock()
+
+    def worker():
+        connection = http.client.HTTPConnection('localhost', port, timeout=60)
+        while True:
+            with counter_lock:
+                index = next(counter, None)
+            if index is None:
+                break
+            method, url, body, headers = make_request(scenario, accounts[index % len(accounts)], options)
+            start = time.perf_counter()
+            try:
+                status, _ = request(connection, method, url, body, headers)
+                error = None if status == 200 else f'HTTP {status}'
+            except (OSError, http.client.HTTPException) as ex:
+                connection.close()  # reopened by the next request
+                error = repr(ex)
+            elapsed = time.perf_counter() - start
+            with results_lock:
+                if error is None:
+                    latencies.append(elapsed)
+                else:
+                    errors.append(error)
+        connection.close()
+
+    threads = [threading.Thread(target=worker) for _ in range(options.concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.perf_counter() - start
+
+    latencies.sort()
+    return {'scenario': scenario,
+            'requests': options.requests,
+            'errors': len(errors),
+            'throughput': len(latencies) / duration,
+            'p50': percentile(latencies, 50),
+            'p95': percentile(latencies, 95),
+            'p99': percentile(latencies, 99),
+            'max': latencies[-1] if latencies else None}
+
+
+def run_cold_scenario(scenario: str, options) -> dict:
+    """Runs the scenario against a separate server started with its COLD_SERVER_ARGS and newly seeded patients."""
+    port = free_port()
+    measurements = options.measurements if scenario == 'get-cold' else 0  # logins don't need any
+    with tempfile.TemporaryDirectory(prefix='medical_registry_benchmark_') as directory:
+        server = start_server(directory, port, [*options.server_arg, *COLD_SERVER_ARGS[scenario]])
+        try:
+            accounts = seed(port, options.patients, measurements, options.batch_size)
+            return run_scenario(scenario, port, accounts, options)
+        finally:
+            stop_server(server)
+
+
+def percentile(sorted_values: list, p: float):
+    """Nearest-rank percentile of an ascending list, None for an empty list."""
+    if not sorted_values:
+        return None
+    rank = max(1, -(-len(sorted_values) * p // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def print_report(results: list):
+    print(f"\n{'scenario':<12}{'requests':>10}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+          f"{'max ms':>10}")
+    for result in results:
+        milliseconds = ['-' if result[key] is None else f'{result[key] * 1000:.1f}'
+                        for key in ('p50', 'p95', 'p99', 'max')]
+        print(f"{result['scenario']:<12}{result['requests']:>10}{result['errors']:>8}{result['throughput']:>10.1f}"
+              + ''.join(f'{value:>10}' for value in milliseconds))
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Load generator and benchmark of the medical registry server')
+    arg_parser.add_argument('--patients', type=int, default=10, help='patients registered before the benchmark')
+    arg_parser.add_argument('--measurements', type=int, default=1000, help='pressure measurements seeded per patient')
+    arg_parser.add_argument('--requests', type=int, default=500, help='requests sent in every scenario')
+    arg_parser.add_argument('--concurrency', type=int, default=8, help='client threads, one connection each')
+    arg_parser.add_argument('--batch-size', type=int, default=100, help='measurements per bulk POST')
+    arg_parser.add_argument('--get-limit', type=int, default=100, help='measurements per GET (query limit)')
+    arg_parser.add_argument('--scenario', action='append', choices=SCENARIOS,
+                            help='scenario to run, can be repeated (default: all)')
+    arg_parser.add_argument('--server-arg', action='append', default=[],
+                            help='argument passed to server.py, e.g. --server-arg=--group-commit-ms=2')
+    arg_parser.add_argument('--port', type=int, default=0, help='server port, 0 picks a free one')
+    arg_parser.add_argument('--json', help='write the results to this file')
+    args = arg_parser.parse_args()
+    if args.patients < 1 or args.requests < 1 or args.concurrency < 1:
+        arg_parser.error('--patients, --requests and --concurrency must be positive')
+
+    port = args.port or free_port()
+    with tempfile.TemporaryDirectory(prefix='medical_registry_benchmark_') as directory:
+        server = start_server(directory, port, args.server_arg)
+        try:
+            start = time.perf_counter()
+            accounts = seed(port, args.patients, args.measurements, args.batch_size)
+            print(f"Seeded {args.patients} patients with {args.measurements} measurements each "
+                  f"in {time.perf_counter() - start:.1f} s")
+
+            results = []
+            for scenario in args.scenario or SCENARIOS:
+                if scenario in COLD_SERVER_ARGS:
+                    results.append(run_cold_scenario(scenario, args))
+                else:
+                    results.append(run_scenario(scenario, port, accounts, args))
+                print(f"{scenario}: done")
+        finally:
+            stop_server(server)
+
+    print_report(results)
+    if args.json:
+        with open(args.json, 'w') as results_file:
+            json.dump({'arguments': vars(args), 'results': results}, results_file, indent=4)
@@ -1,6 +1,7 @@
 import socket
 import sys
 import json
+from urllib import parse
 
 """
 Klient łączący się z serwerem (server.py). Przekształca wprowadzone przez użytkownika w terminalu dane na zapytanie
@@ -11,7 +12,8 @@ serwerze:
 
     > username:password
     można testować uzyskiwanie dostępu do bazy danych na serwerze korzystając z poniższych danych logowania
-    (zostają wprowadzone do bazy danych jako Credentials testowych pacjentów w trakcie jej inicjalizacji w database.py):
+    (zostają wprowadzone do bazy danych jako Credentials testowych pacjentów, jeżeli serwer uruchomiono z opcją
+    --seed-demo, patrz database.fake_fill_db):
     
     (Andrzej Mamut) | admin:admin   
     (Jan Kowalski)  | jan:kowalski63
@@ -43,7 +45,9 @@ username = input("Please enter username: ")
 password = input("Please enter password: ")
 method = input("GET or POST?: ").strip().upper()
 
-req = f'{method} /patient?username={username}&password={password} HTTP/1/1\r\n'
+credentials = parse.urlencode({'username': username, 'password': password}, quote_via=parse.quote)
+req = f'{method} /patient?{credentials} HTTP/1.1\r\n'
+req += 'Connection: close\r\n'  # the response is read until the server closes the connection
 
 
 if method == 'GET':
@@ -58,8 +62,6 @@ elif method == 'POST':
             break
         print("Wrong entry type! Please select one from (patient/pressure/temperature). Try again")
 
-    req += '\r\n'
-
     if entry_type == 'patient':
         while True:
             date_time_raw = input("Enter day of birth in format: Year/Month/Day\n").strip()
@@ -133,7 +135,10 @@ elif method == 'POST':
             pre_json_dict = {'value': value,
                              'acquisition': date_time_raw}
 
-    req += json.dumps(pre_json_dict, indent=4)
+    body = json.dumps(pre_json_dict, indent=4)
+    req += f'Content-Length: {len(body.encode())}\r\n'
+    req += '\r\n'
+    req += body
 
 else:
     print(f"Unimplemented method: {method}\nTry 'GET' or 'POST'")
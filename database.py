@@ -1,9 +1,17 @@
 import sqlite3
 import json
-import sys
+import logging
+import base64
 import datetime
+import hashlib
+import threading
+import time
+import contextlib
+import queue
+from collections import OrderedDict
 import cryptography.fernet
 import encryption as enc
+import metrics
 
 """
 Moduł inicjalizujący bazę danych w SQLite i zarządzający nią. Fukcje zdefiniowane w module udostępniają 
@@ -12,7 +20,7 @@ Zdefiniowana baza danych zawiera następujące tablice:
     >Patient - zawiera dane o zarejestrowanych pacjentach (nazwisko, imię, data urodzenia itp.), 
     każdy pacjent przypisany jest do dokładnie jednego rekordu w Credentials i każdy rekord w Credentials odpowiada
     tylko jednemu pacjentowi (1:1).
-    Rekordy zawarte w Patient podlegają szyfrowaniu hasłem pacjenta.
+    Rekordy zawarte w Patient podlegają szyfrowaniu kluczem danych pacjenta.
      
     >Pressure - zawiera dane o wprowadzonych pomiarach ciśnienia, każdy rekord w Pressure przypisany jest do dokładnie
     jednego pacjenta, ale wiele różnych rekordów może byc przypisanych do tego samego pacjenta (1:n).
@@ -24,10 +32,21 @@ Zdefiniowana baza danych zawiera następujące tablice:
 
     
     >Credentials - zawiera dane logowania pacjenta (login, hasło).
-     Rekordy zawarte w Credentials podlegają szyfrowaniu hasłem pacjenta.
+     Rekordy zawarte w Credentials podlegają szyfrowaniu hasłem pacjenta. Kolumna username_hash (HMAC loginu kluczem
+     serwera, patrz encryption.username_digest) z unikalnym indeksem pozwala znaleźć rekord jednym zapytaniem.
+     Kolumny kdf_salt i wrapped_key przechowują losowy klucz danych pacjenta zaszyfrowany kluczem wyprowadzonym
+     z hasła (patrz encryption.wrap_key), hasło nie jest przechowywane - poprawność hasła potwierdza odszyfrowanie
+     klucza danych. kdf_params określa funkcję wyprowadzającą klucz i jej parametry (NULL - PBKDF2, 100 000
+     iteracji). Zmiana hasła (change_password) zmienia tylko te trzy kolumny.
+     Rekordy utworzone przez starszą wersję modułu (bez username_hash) są uzupełniane przy pierwszym logowaniu
+     właściciela. Login takiego rekordu można odczytać tylko hasłem właściciela, więc nowe konto może otrzymać ten
+     sam login - nieudane logowanie do nowego konta sprawdza wtedy rekordy starszej wersji, a rekord, którego
+     username_hash jest już zajęty, pozostaje niezmigrowany.
     
-Inicjalizacja zachodzi podczas importu tego modułu w module server.py, jeżeli tablica Credentials jest pusta, to
-wywołana zostaje funkcja fake_fill_db() wprowadzająca do bazy danych dane 3 testowych pacjentów:
+Import modułu nie otwiera bazy danych. initialize() tworzy brakujące tablice i indeksy oraz dostosowuje schemat bazy
+utworzonej przez starszą wersję modułu (migrate()), a connect() otwiera połączenia używane przez pozostałe funkcje.
+initialize(seed_demo=True) (server.py --seed-demo) wywołuje dodatkowo, jeżeli tablica Credentials jest pusta,
+funkcję fake_fill_db() wprowadzającą do bazy danych dane 3 testowych pacjentów:
 
     > Andrzej Mamut (username=admin, password=admin)
     > Jan Kowalski (username=jan, password=kowalski63)
@@ -40,46 +59,278 @@ class SecurityError(Exception):
 
 
 MEDICAL_REGISTRY = 'medical_registry.sqlite3'
-conn = sqlite3.connect(MEDICAL_REGISTRY)
-conn.row_factory = sqlite3.Row
-cur = conn.cursor()
+lock = threading.RLock()  # serializes use of conn/cur, hold it across statements that must share one transaction
+log = logging.getLogger('database')
+POOL_SIZE = 8  # read connections opened by connect(), reads don't wait for `lock`
+POOL_TIMEOUT = 30.0  # seconds a reader waits for a free connection of an exhausted pool
+
+DATE_OF_BIRTH_CACHE_SIZE = 4096  # patients whose decrypted date of birth is kept for validate_timestamp()
+_date_of_birth_cache = OrderedDict()  # patient_id -> sqlite3.Date
+_date_of_birth_lock = threading.Lock()
+RESPONSE_CACHE_SIZE = 16 * 1024 * 1024  # bytes of GET responses kept by response_cache, 0 disables it
+
+# pragmas applied by connect(), WAL lets readers work alongside a writer and with synchronous=NORMAL a commit doesn't
+# wait for fsync (the database stays consistent, only the last transactions may be lost on power failure)
+CONNECTION_PROFILE = {'journal_mode': 'WAL',
+                      'synchronous': 'NORMAL',
+                      'mmap_size': 256 * 1024 * 1024,  # bytes
+                      'cache_size': -64 * 1024,  # negative values are KiB
+                      'temp_store': 'MEMORY',
+                      'busy_timeout': 5000}  # ms
+PRAGMA_NAMES = {'synchronous': {0: 'OFF', 1: 'NORMAL', 2: 'FULL', 3: 'EXTRA'},
+                'temp_store': {0: 'DEFAULT', 1: 'FILE', 2: 'MEMORY'}}
+conn = None  # writer connection and its cursor, opened by connect()
+cur = None
+pool = None  # ConnectionPool of read connections, opened by connect()
 
 # cur.execute("DROP TABLE IF EXISTS Patient")
 # cur.execute("DROP TABLE IF EXISTS Pressure")
 # cur.execute("DROP TABLE IF EXISTS Temperature")
 # cur.execute("DROP TABLE IF EXISTS Credentials")
 
-cur.execute('''CREATE TABLE IF NOT EXISTS Patient
-            (id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT UNIQUE,
-             last_name BLOB,
-             first_name BLOB,
-             date_of_birth BLOB,
-             registration_timestamp DATETIME DEFAULT (datetime('now', 'localtime')),
-             credentials_id INTEGER,
-             UNIQUE (last_name, first_name),
-             UNIQUE (credentials_id))''')
-
-cur.execute('''CREATE TABLE IF NOT EXISTS Pressure
+
+def create_schema():
+    """Creates the tables of an empty database."""
+    cur.execute('''CREATE TABLE IF NOT EXISTS Patient
                 (id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT UNIQUE,
-                systolic FLOAT,
-                diastolic FLOAT,
-                press_acquisition DATETIME,
-                press_entry_timestamp DATETIME DEFAULT (datetime('now', 'localtime')),
-                patient_id INTEGER
-                )''')
-
-cur.execute('''CREATE TABLE IF NOT EXISTS Temperature(
-                id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT UNIQUE,
-                value FLOAT,
-                temp_acquisition DATETIME,
-                temp_entry_timestamp DATETIME DEFAULT (datetime('now', 'localtime')),
-                patient_id INTEGER)''')
-
-cur.execute('''CREATE TABLE IF NOT EXISTS Credentials(
-                id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT UNIQUE,
-                username BLOB,
-                password BLOB,
-                UNIQUE (username))''')
+                 last_name BLOB,
+                 first_name BLOB,
+                 date_of_birth BLOB,
+                 registration_timestamp DATETIME DEFAULT (datetime('now', 'localtime')),
+                 credentials_id INTEGER,
+                 UNIQUE (last_name, first_name),
+                 UNIQUE (credentials_id))''')
+
+    cur.execute('''CREATE TABLE IF NOT EXISTS Pressure
+                    (id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT UNIQUE,
+                    systolic FLOAT,
+                    diastolic FLOAT,
+                    press_acquisition DATETIME,
+                    press_entry_timestamp DATETIME DEFAULT (datetime('now', 'localtime')),
+                    patient_id INTEGER
+                    )''')
+
+    cur.execute('''CREATE TABLE IF NOT EXISTS Temperature(
+                    id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT UNIQUE,
+                    value FLOAT,
+                    temp_acquisition DATETIME,
+                    temp_entry_timestamp DATETIME DEFAULT (datetime('now', 'localtime')),
+                    patient_id INTEGER)''')
+
+    cur.execute('''CREATE TABLE IF NOT EXISTS Credentials(
+                    id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT UNIQUE,
+                    username BLOB,
+                    password BLOB,
+                    username_hash TEXT,
+                    kdf_salt BLOB,
+                    kdf_params TEXT,
+                    wrapped_key BLOB,
+                    UNIQUE (username))''')
+
+
+def migrate():
+    """Brings a database created by an older version of this module up to the current schema (idempotent)."""
+    credentials_columns = [row[1] for row in cur.execute("PRAGMA table_info(Credentials)")]
+    if 'username_hash' not in credentials_columns:
+        # rows registered before this column existed are backfilled on their owner's next successful login,
+        # their plaintext username can't be recovered without the patient's password
+        cur.execute('''ALTER TABLE Credentials ADD COLUMN username_hash TEXT''')
+    if 'wrapped_key' not in credentials_columns:
+        # rows without a wrapped data key get one on their owner's next successful login (validate_legacy_user)
+        cur.execute('''ALTER TABLE Credentials ADD COLUMN kdf_salt BLOB''')
+        cur.execute('''ALTER TABLE Credentials ADD COLUMN wrapped_key BLOB''')
+    if 'kdf_params' not in credentials_columns:  # NULL is enc.LEGACY_KDF_PARAMS, rewrapped on the next login
+        cur.execute('''ALTER TABLE Credentials ADD COLUMN kdf_params TEXT''')
+
+    cur.execute('''CREATE UNIQUE INDEX IF NOT EXISTS idx_credentials_username_hash ON Credentials (username_hash)''')
+
+    # a patient's history is read ordered by acquisition time (get), rows with the same acquisition are ordered by
+    # rowid (id) stored at the end of every index entry. Patient (credentials_id) is covered by its UNIQUE constraint
+    cur.execute('''CREATE INDEX IF NOT EXISTS idx_pressure_patient_acquisition
+                    ON Pressure (patient_id, press_acquisition)''')
+    cur.execute('''CREATE INDEX IF NOT EXISTS idx_temperature_patient_acquisition
+                    ON Temperature (patient_id, temp_acquisition)''')
+    conn.commit()
+
+
+class GroupCommit:
+    """
+    Shares one conn.commit() between concurrent writers. commit() returns once a transaction containing the caller's
+    writes is durable; the first writer of a batch waits up to max_latency seconds (or until max_batch writers have
+    joined) and then commits for all of them. While waiting `lock` is released, so other writers can add their rows.
+    """
+
+    def __init__(self, max_latency: float = 0.005, max_batch: int = 64):
+        self.max_latency = max_latency
+        self.max_batch = max_batch
+        self.condition = threading.Condition(lock)
+        self.pending = 0  # writers waiting for the open transaction to be committed
+        self.epoch = 0  # number of finished commits
+        self.errors = {}  # epoch -> exception of a commit that failed (and was rolled back)
+        self.commits = 0
+        self.writes = 0
+
+    def commit(self):
+        with self.condition:
+            epoch = self.epoch
+            self.pending += 1
+            if self.pending < self.max_batch:
+                deadline = time.monotonic() + self.max_latency
+                while self.epoch == epoch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+            if self.epoch == epoch:
+                self.flush()
+            elif epoch + 1 in self.errors:
+                raise self.errors[epoch + 1]
+
+    def flush(self):
+        """Needs self.condition (lock) to be held."""
+        self.writes += self.pending
+        self.pending = 0
+        self.epoch += 1
+        try:
+            conn.commit()
+            self.commits += 1
+        except sqlite3.Error as ex:
+            conn.rollback()
+            self.errors[self.epoch] = ex
+            self.errors.pop(self.epoch - 100, None)
+            raise
+        finally:
+            self.condition.notify_all()
+
+
+group_commit = None  # GroupCommit shared by all writers, None commits every write on its own
+_atomic_depth = 0
+
+
+class ConnectionPool:
+    """
+    Read-only connections to the database, each used by one thread at a time (checkout() .. checkin()). In WAL mode
+    readers don't block the writer (`conn`) nor each other, they see data committed before their query started.
+    Connections are opened on demand, at most max_size of them.
+    """
+
+    def __init__(self, db_path, profile: dict = None, max_size: int = POOL_SIZE):
+        self.db_path = db_path
+        self.profile = {**CONNECTION_PROFILE, **(profile or {})}
+        self.max_size = max_size
+        self._idle = queue.LifoQueue()  # the most recently used connection has the warmest page cache
+        self._opened = 0
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def _open(self):
+        connection = sqlite3.connect(self.db_path, check_same_thread=False)  # checked out by any worker thread
+        connection.row_factory = sqlite3.Row
+        apply_profile(connection, {pragma: value for pragma, value in self.profile.items() if pragma != 'journal_mode'})
+        connection.execute("PRAGMA query_only=1")
+        return connection
+
+    def checkout(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._closed:
+                raise sqlite3.ProgrammingError("Connection pool is closed")
+            can_open = self._opened < self.max_size
+            if can_open:
+                self._opened += 1
+        if can_open:
+            try:
+                return self._open()
+            except Exception:
+                with self._lock:
+                    self._opened -= 1
+                raise
+        try:
+            return self._idle.get(timeout=POOL_TIMEOUT)
+        except queue.Empty:
+            raise sqlite3.OperationalError(f"No free connection in the pool after {POOL_TIMEOUT} s")
+
+    def checkin(self, connection):
+        if self._closed:
+            connection.close()
+        else:
+            self._idle.put(connection)
+
+    @contextlib.contextmanager
+    def connection(self):
+        connection = self.checkout()
+        try:
+            yield connection
+        finally:
+            self.checkin(connection)
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+def enable_group_commit(max_latency: float, max_batch: int):
+    global group_commit
+    group_commit = GroupCommit(max_latency, max_batch) if max_latency > 0 and max_batch > 1 else None
+
+
+def commit():
+    """Makes the caller's writes durable. Inside atomic() the commit is left to the end of the outermost block."""
+    if _atomic_depth > 0:
+        return
+    with metrics.phase('commit'):
+        if group_commit is not None:
+            group_commit.commit()
+        else:
+            conn.commit()
+
+
+@contextlib.contextmanager
+def atomic():
+    """
+    Block of writes that succeed or fail together. On an exception only the block's own statements are undone
+    (ROLLBACK TO SAVEPOINT), writes of other requests waiting for a group commit stay intact.
+    """
+    global _atomic_depth
+    with lock:
+        began = not conn.in_transaction
+        if began:
+            # a SAVEPOINT alone starts a deferred transaction, under WAL a read in it takes a snapshot that can't be
+            # upgraded to a write once another process has committed (SQLITE_BUSY_SNAPSHOT, busy_timeout doesn't help)
+            cur.execute('BEGIN IMMEDIATE')
+        savepoint = f'atomic_{_atomic_depth}'
+        cur.execute(f'SAVEPOINT {savepoint}')
+        _atomic_depth += 1
+        try:
+            yield
+        except BaseException:
+            cur.execute(f'ROLLBACK TO {savepoint}')
+            cur.execute(f'RELEASE {savepoint}')
+            if began:  # `lock` was held throughout, the transaction has only this block's writes
+                conn.rollback()  # ends it, an open transaction keeps the database write lock
+            raise
+        finally:
+            _atomic_depth -= 1
+        cur.execute(f'RELEASE {savepoint}')
+        commit()
+
+
+def end_failed_write():
+    """
+    Rolls back the transaction left open by a failed statement whose error was handled, so that it doesn't keep the
+    database write lock. Needs `lock`; transactions of atomic() blocks or with writes waiting for a group commit are
+    left to their owners.
+    """
+    if _atomic_depth == 0 and conn.in_transaction and (group_commit is None or group_commit.pending == 0):
+        conn.rollback()
 
 
 def validate_date(date):
@@ -87,108 +338,382 @@ def validate_date(date):
         raise ValueError("The date is from the future")
 
 
-def validate_timestamp(timestamp, patient_id, fernet):
+def get_date_of_birth(patient_id, fernet):
+    """Decrypted date of birth of the patient, queried and decrypted only on the first call for a patient."""
+    with _date_of_birth_lock:
+        date_of_birth = _date_of_birth_cache.get(patient_id)
+        if date_of_birth is not None:
+            _date_of_birth_cache.move_to_end(patient_id)
+            return date_of_birth
+
+    with lock, metrics.phase('sql'):
+        date_of_birth = cur.execute("SELECT date_of_birth FROM Patient WHERE id=?", (patient_id,)).fetchone()[0]
+    with metrics.phase('decrypt'):
+        date_of_birth = sqlite3.Date(*map(int, fernet.decrypt(date_of_birth).decode().split('-')))
+
+    with _date_of_birth_lock:
+        _date_of_birth_cache[patient_id] = date_of_birth
+        while len(_date_of_birth_cache) > DATE_OF_BIRTH_CACHE_SIZE:
+            _date_of_birth_cache.popitem(last=False)
+    return date_of_birth
+
+
+def forget_date_of_birth(patient_id):
+    """Drops the cached date of birth, has to be called whenever the Patient row is inserted or changed."""
+    with _date_of_birth_lock:
+        _date_of_birth_cache.pop(patient_id, None)
+
+
+def make_etag(body: bytes) -> str:
+    return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+
+class ResponseCache:
+    """
+    Thread-safe LRU cache of encoded responses with patient's data, bounded by their total size. invalidate() drops
+    the entries of a patient and has to be called after every committed write of the patient's rows.
+    """
+
+    def __init__(self, max_bytes: int = RESPONSE_CACHE_SIZE):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # (patient_id, query) -> (body, etag)
+        self._patient_keys = {}  # patient_id -> keys of its entries
+        self._versions = {}  # patient_id -> invalidations, a response read before one mustn't be stored after it
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, patient_id: int, query, factory):
+        """
+        (body, etag) of the cached response to a hashable query or of factory() -> bytes (called without the lock
+        held), None without caching if factory() returns None.
+        """
+        key = (patient_id, query)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            self.misses += 1
+            version = self._versions.get(patient_id, 0)
+
+        body = factory()
+        if body is None:
+            return None
+        entry = (body, make_etag(body))
+
+        if len(body) <= self.max_bytes:
+            with self._lock:
+                if self._versions.get(patient_id, 0) == version and key not in self._entries:
+                    self._entries[key] = entry
+                    self._patient_keys.setdefault(patient_id, set()).add(key)
+                    self._bytes += len(body)
+                    while self._bytes > self.max_bytes:
+                        self._remove(next(iter(self._entries)))
+                        self.evictions += 1
+        return entry
+
+    def _remove(self, key):
+        body, _ = self._entries.pop(key)
+        self._bytes -= len(body)
+        patient_keys = self._patient_keys[key[0]]
+        patient_keys.discard(key)
+        if not patient_keys:
+            del self._patient_keys[key[0]]
+
+    def invalidate(self, patient_id: int):
+        with self._lock:
+            self._versions[patient_id] = self._versions.get(patient_id, 0) + 1
+            for key in list(self._patient_keys.get(patient_id, ())):
+                self._remove(key)
+            self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            for patient_id in self._patient_keys:
+                self._versions[patient_id] = self._versions.get(patient_id, 0) + 1
+            self._entries.clear()
+            self._patient_keys.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'entries': len(self._entries), 'bytes': self._bytes, 'max_bytes': self.max_bytes,
+                    'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else 0.0,
+                    'evictions': self.evictions, 'invalidations': self.invalidations}
+
+
+response_cache = ResponseCache()
+
+
+def validate_timestamp(timestamp, patient_id, fernet, date_of_birth=None):
     if (datetime.datetime.now() - timestamp).total_seconds() < 0:
         raise ValueError("The timestamp is from the future")
-    date_of_birth = sqlite3.Date(*map(int, fernet.decrypt(cur.execute("SELECT date_of_birth FROM Patient WHERE id=?",
-                                                                      (patient_id,)).fetchone()[0]).decode().split('-')))
+    if date_of_birth is None:
+        date_of_birth = get_date_of_birth(patient_id, fernet)
     if (timestamp.date() - date_of_birth).days < 0:
         raise ValueError("The timestamp is from before the day of birth of the patient")
 
 
-def register(username, password) -> int:
-    """Need to call conn.commit() after or conn.rollback() if something went wrong"""
-    fernet = enc.make_Fernet(password)
+def has_legacy_credentials() -> bool:
+    """Whether some Credentials rows have no username_hash yet (their owners haven't logged in since)."""
+    with pool.connection() as connection:
+        row = connection.execute('''SELECT 1 FROM Credentials WHERE username_hash IS NULL LIMIT 1''').fetchone()
+    return row is not None
+
 
-    cur.execute('''SELECT id, username, password FROM Credentials''')
-    for row in cur:
+def scan_legacy_credentials(fernet, username: str, password: str = None):
+    """Linear decrypt-and-compare search over Credentials rows that have no username_hash yet."""
+    with pool.connection() as connection:
+        rows = connection.execute('''SELECT id, username, password FROM Credentials
+                                     WHERE username_hash IS NULL''').fetchall()
+    for row in rows:
         try:
-            if fernet.decrypt(row['username']).decode() == username:
-                raise sqlite3.IntegrityError('User already registered!')
+            if fernet.decrypt(row['username']).decode() == username and (
+                    password is None or fernet.decrypt(row['password']).decode() == password):
+                return row['id']
         except (cryptography.fernet.InvalidToken, TypeError):
             pass
-    else:
-        username = fernet.encrypt(username.encode())
-        password = fernet.encrypt(password.encode())
-        cur.execute('''INSERT INTO Credentials (username, password) VALUES (?, ?)''', (username, password))
+    return None
+
+
+def prepare_registration(username: str, password: str) -> tuple:
+    """
+    Duplicate check and key derivation of a new account, done before `lock` is taken so that other writers don't wait
+    for the KDF. Raises sqlite3.IntegrityError if the username is taken, the result is passed to register().
+    Usernames of legacy credentials can't be checked (see validate_user).
+    """
+    username_hash = enc.username_digest(username)
+    with pool.connection() as connection:
+        taken = connection.execute('''SELECT 1 FROM Credentials WHERE username_hash=?''', (username_hash,)).fetchone()
+    if taken is not None:
+        raise sqlite3.IntegrityError('User already registered!')
+
+    fernet = enc.new_data_key()
+    kdf_salt, kdf_params, wrapped_key = enc.wrap_key(fernet, password)
+    return username_hash, fernet.encrypt(username.encode()), kdf_salt, kdf_params, wrapped_key, fernet
+
+
+def register(registration: tuple) -> tuple:
+    """
+    Inserts the account of prepare_registration(), has to be called inside atomic() together with insert_patient().
+    Returns (cred_id, fernet), a concurrent registration of the same username fails the UNIQUE index.
+    """
+    username_hash, username, kdf_salt, kdf_params, wrapped_key, fernet = registration
+    with lock:
+        cur.execute('''INSERT INTO Credentials (username, username_hash, kdf_salt, kdf_params, wrapped_key)
+                       VALUES (?, ?, ?, ?, ?)''', (username, username_hash, kdf_salt, kdf_params, wrapped_key))
         cred_id = cur.lastrowid
         return cred_id, fernet
 
 
-def validate_user(username: str, password: str) -> int:
+def validate_legacy_user(username: str, password: str, username_hash: str, row):
+    """
+    Checks credentials encrypted with the key derived from the password and the static enc.salt. On success that key
+    becomes the patient's data key: it is wrapped (no data is re-encrypted) and the password is no longer stored.
+    Returns (cred_id, fernet), cred_id is None if the credentials are invalid.
+    """
     fernet = enc.make_Fernet(password)
-
-    cur.execute('''SELECT id, username, password FROM Credentials''')
-    for row in cur:
+    if row is not None:
         try:
             if fernet.decrypt(row['username']).decode() == username and fernet.decrypt(
                     row['password']).decode() == password:
                 cred_id = row['id']
-                break
+            else:
+                cred_id = None
+        except (cryptography.fernet.InvalidToken, TypeError):
+            cred_id = None
+    else:
+        cred_id = scan_legacy_credentials(fernet, username, password)
+    if cred_id is None:
+        return None, fernet
+
+    kdf_salt, kdf_params, wrapped_key = enc.wrap_key(fernet, password)
+    with lock:
+        try:
+            cur.execute('''UPDATE Credentials SET username_hash=?, password=NULL, kdf_salt=?, kdf_params=?,
+                           wrapped_key=? WHERE id=?''', (username_hash, kdf_salt, kdf_params, wrapped_key, cred_id))
+        except sqlite3.IntegrityError:  # a new account was registered with the same username
+            log.warning(f"Legacy credentials {cred_id} can't be migrated, their username is taken")
+            end_failed_write()
+            return cred_id, fernet
+        commit()
+    enc.invalidate_Fernet(password)
+    return cred_id, fernet
+
+
+def validate_user(username: str, password: str) -> int:
+    username_hash = enc.username_digest(username)
+    with pool.connection() as connection, metrics.phase('sql'):
+        row = connection.execute('''SELECT id, username, password, kdf_salt, kdf_params, wrapped_key FROM Credentials
+                                    WHERE username_hash=?''', (username_hash,)).fetchone()
+
+    if row is not None and row['wrapped_key'] is not None:
+        cred_id = None
+        try:  # a wrong password fails the HMAC check of the wrapped key
+            fernet = enc.unwrap_key(password, row['kdf_salt'], row['wrapped_key'], row['kdf_params'])
+            if fernet.decrypt(row['username']).decode() == username:
+                cred_id = row['id']
         except cryptography.fernet.InvalidToken:
             pass
+        if cred_id is None and has_legacy_credentials():
+            # the owner of a not yet migrated account with the same username mustn't be locked out
+            cred_id, fernet = validate_legacy_user(username, password, username_hash, None)
+            if cred_id is not None:
+                row = None  # the legacy row, its key isn't wrapped
     else:
-        cred_id = None
+        cred_id, fernet = validate_legacy_user(username, password, username_hash, row)
 
-    if cred_id is not None:
-        patient_id = cur.execute('''SELECT id FROM Patient WHERE credentials_id=?''', (cred_id,)).fetchone()[0]
-        return patient_id, fernet
-    else:
+    if cred_id is None:
         raise SecurityError("Invalid credentials!")
+    with pool.connection() as connection, metrics.phase('sql'):
+        patient_id = connection.execute('''SELECT id FROM Patient WHERE credentials_id=?''', (cred_id,)).fetchone()[0]
+    if row is not None and row['wrapped_key'] is not None and enc.needs_rewrap(row['kdf_params']):
+        rewrap_key(patient_id, fernet, password)  # KDF parameters were changed (enc.KDF_CONFIG_FILE)
+    return patient_id, fernet
+
+
+def rewrap_key(patient_id: int, fernet, password: str):
+    """Stores the patient's data key wrapped with password and the current enc.kdf_params()."""
+    kdf_salt, kdf_params, wrapped_key = enc.wrap_key(fernet, password)
+    with lock:
+        cur.execute('''UPDATE Credentials SET kdf_salt=?, kdf_params=?, wrapped_key=?
+                       WHERE id=(SELECT credentials_id FROM Patient WHERE id=?)''',
+                    (kdf_salt, kdf_params, wrapped_key, patient_id))
+        commit()
+
+
+def change_password(username: str, password: str, new_password: str) -> int:
+    """Rewraps the patient's data key with new_password, none of the patient's data is re-encrypted."""
+    if not new_password:
+        raise ValueError("The new password is empty")
+    patient_id, fernet = validate_user(username, password)
+    rewrap_key(patient_id, fernet, new_password)
+    return patient_id
+
+
+def validate_session(token: str):
+    """(patient_id, fernet) of a session token from enc.issue_session_token(), no key derivation is needed."""
+    try:
+        return enc.open_session_token(token)
+    except (cryptography.fernet.InvalidToken, ValueError, KeyError, TypeError):
+        raise SecurityError("Invalid or expired session token!")
 
 
 def insert_patient(last_name: str, first_name: str, year: int, month: int, day: int, credentials_id: int,
                    fernet) -> int:
-    try:
-        day_of_birth = sqlite3.Date(year, month, day)
-        validate_date(day_of_birth)  # raises ValueError if day_of_birth is from the future
+    with lock:
+        try:
+            day_of_birth = sqlite3.Date(year, month, day)
+            validate_date(day_of_birth)  # raises ValueError if day_of_birth is from the future
 
-        last_name = fernet.encrypt(last_name.encode())
-        first_name = fernet.encrypt(first_name.encode())
-        day_of_birth = fernet.encrypt(str(day_of_birth).encode())
+            last_name = fernet.encrypt(last_name.encode())
+            first_name = fernet.encrypt(first_name.encode())
+            day_of_birth = fernet.encrypt(str(day_of_birth).encode())
 
-        cur.execute(
-            '''INSERT INTO Patient (last_name, first_name, date_of_birth, credentials_id) VALUES (?, ?, ?, ?)''',
-            (last_name, first_name, day_of_birth, credentials_id))
-        conn.commit()
-        patient_id = cur.lastrowid
+            with metrics.phase('sql'):
+                cur.execute(
+                    '''INSERT INTO Patient (last_name, first_name, date_of_birth, credentials_id) VALUES (?, ?, ?, ?)''',
+                    (last_name, first_name, day_of_birth, credentials_id))
+            patient_id = cur.lastrowid
+            forget_date_of_birth(patient_id)  # the id may have belonged to a row rolled back by atomic()
+            commit()
+            response_cache.invalidate(patient_id)
 
-    except sqlite3.IntegrityError:
-        print(f"Patient: {last_name} {first_name} already in register!", file=sys.stderr)
-        patient_id = cur.execute('SELECT id FROM Patient WHERE last_name=? and first_name=?',
-                                 (last_name, first_name)).fetchone()[0]
+        except sqlite3.IntegrityError:
+            log.warning(f"Patient: {last_name} {first_name} already in register!")
+            end_failed_write()
+            patient_id = cur.execute('SELECT id FROM Patient WHERE last_name=? and first_name=?',
+                                     (last_name, first_name)).fetchone()[0]
 
-    return patient_id
+        return patient_id
 
 
 def insert_pressure(systolic: float, diastolic: float, year: int, month: int, day: int, hour: int, minute: int,
                     patient_id: int, fernet) -> int:
-    timestamp = sqlite3.Timestamp(year=year, month=month, day=day, hour=hour, minute=minute)
-    validate_timestamp(timestamp,
-                       patient_id,
-                       fernet)  # raises ValueError if timestamp is from the future or from before patient's birth
+    with lock:
+        timestamp = sqlite3.Timestamp(year=year, month=month, day=day, hour=hour, minute=minute)
+        validate_timestamp(timestamp,
+                           patient_id,
+                           fernet)  # raises ValueError if timestamp is from the future or from before patient's birth
 
-    cur.execute('''INSERT INTO Pressure (systolic, diastolic, press_acquisition, patient_id) VALUES (?, ?, ?, ?)''',
-                (systolic, diastolic, timestamp, patient_id))
-    conn.commit()
-    return patient_id
+        with metrics.phase('sql'):
+            cur.execute('''INSERT INTO Pressure (systolic, diastolic, press_acquisition, patient_id) VALUES (?, ?, ?, ?)''',
+                        (systolic, diastolic, timestamp, patient_id))
+        row_id = cur.lastrowid
+        commit()
+        response_cache.invalidate(patient_id)  # after the commit, a read that doesn't see the row isn't cached
+        return row_id
 
 
 def insert_temperature(value: float, year: int, month: int, day: int, hour: int, minute: int, patient_id: int,
                        fernet) -> int:
-    timestamp = sqlite3.Timestamp(year=year, month=month, day=day, hour=hour, minute=minute)
-    validate_timestamp(timestamp,
-                       patient_id,
-                       fernet)  # raises ValueError if timestamp is from the future or from before patient's birth
+    with lock:
+        timestamp = sqlite3.Timestamp(year=year, month=month, day=day, hour=hour, minute=minute)
+        validate_timestamp(timestamp,
+                           patient_id,
+                           fernet)  # raises ValueError if timestamp is from the future or from before patient's birth
 
-    cur.execute('''INSERT INTO Temperature (value, temp_acquisition, patient_id) VALUES (?, ?, ?)''',
-                (value, timestamp, patient_id))
-    conn.commit()
-    return patient_id
+        with metrics.phase('sql'):
+            cur.execute('''INSERT INTO Temperature (value, temp_acquisition, patient_id) VALUES (?, ?, ?)''',
+                        (value, timestamp, patient_id))
+        row_id = cur.lastrowid
+        commit()
+        response_cache.invalidate(patient_id)  # after the commit, a read that doesn't see the row isn't cached
+        return row_id
+
+
+def insert_batch(insert_query: str, make_row, entries: list, patient_id: int, fernet) -> list:
+    """
+    Validates every entry (dicts of insert_pressure/insert_temperature keyword arguments), inserts the valid ones with
+    one executemany() in an atomic() block (all or none of them) and a single commit. Returns the row id of each inserted entry and an error message (str) for
+    each rejected one.
+    """
+    with lock:
+        date_of_birth = get_date_of_birth(patient_id, fernet)  # decrypted once for the whole batch
+        rows = []
+        results = []
+        for entry in entries:
+            try:
+                timestamp = sqlite3.Timestamp(year=entry['year'], month=entry['month'], day=entry['day'],
+                                              hour=entry['hour'], minute=entry['minute'])
+                validate_timestamp(timestamp, patient_id, fernet, date_of_birth)
+            except (KeyError, ValueError, TypeError) as ex:
+                results.append(f"Bad entry value: {ex}")
+                continue
+            rows.append(make_row(entry, timestamp))
+            results.append(None)
+
+        with atomic(), metrics.phase('sql'):  # a failure part way through doesn't leave half of the batch behind
+            cur.executemany(insert_query, rows)
+            # AUTOINCREMENT ids of rows inserted by one statement of the only writer are consecutive
+            last_id = cur.execute('SELECT last_insert_rowid()').fetchone()[0]
+        row_ids = iter(range(last_id - len(rows) + 1, last_id + 1))
+        results = [next(row_ids) if result is None else result for result in results]
+        if rows:
+            response_cache.invalidate(patient_id)
+        return results
+
+
+def insert_pressure_batch(entries: list, patient_id: int, fernet) -> list:
+    return insert_batch('''INSERT INTO Pressure (systolic, diastolic, press_acquisition, patient_id) VALUES (?, ?, ?, ?)''',
+                        lambda entry, timestamp: (entry['systolic'], entry['diastolic'], timestamp, patient_id),
+                        entries, patient_id, fernet)
+
+
+def insert_temperature_batch(entries: list, patient_id: int, fernet) -> list:
+    return insert_batch('''INSERT INTO Temperature (value, temp_acquisition, patient_id) VALUES (?, ?, ?)''',
+                        lambda entry, timestamp: (entry['value'], timestamp, patient_id),
+                        entries, patient_id, fernet)
 
 
 def fake_fill_db():
-    cred_id, fernet = register('admin', 'admin')
+    cred_id, fernet = register(prepare_registration('admin', 'admin'))
     last_id = insert_patient('Mamut', 'Andrzej', 1985, 9, 4, cred_id, fernet)
 
     insert_temperature(36.7, year=2021, month=12, day=12, hour=16, minute=31, patient_id=last_id, fernet=fernet)
@@ -199,7 +724,7 @@ def fake_fill_db():
     insert_pressure(124.5, 81.2, year=2021, month=12, day=12, hour=19, minute=11, patient_id=last_id, fernet=fernet)
     insert_pressure(122.0, 79.1, year=2021, month=4, day=5, hour=11, minute=11, patient_id=last_id, fernet=fernet)
 
-    cred_id, fernet = register('jan', 'kowalski63')
+    cred_id, fernet = register(prepare_registration('jan', 'kowalski63'))
     last_id = insert_patient('Kowalski', 'Jan', 1963, 10, 2, cred_id, fernet)
 
     insert_temperature(36.7, year=2017, month=2, day=1, hour=13, minute=12, patient_id=last_id, fernet=fernet)
@@ -210,7 +735,7 @@ def fake_fill_db():
     insert_pressure(124.5, 81.2, year=2021, month=12, day=12, hour=19, minute=11, patient_id=last_id, fernet=fernet)
     insert_pressure(122.0, 79.1, year=2021, month=4, day=5, hour=11, minute=11, patient_id=last_id, fernet=fernet)
 
-    cred_id, fernet = register('anna', 'nowak81')
+    cred_id, fernet = register(prepare_registration('anna', 'nowak81'))
     last_id = insert_patient('Nowak', 'Anna', 1981, 2, 28, cred_id, fernet)
 
     insert_temperature(35.5, year=2019, month=4, day=10, hour=4, minute=8, patient_id=last_id, fernet=fernet)
@@ -221,62 +746,285 @@ def fake_fill_db():
     insert_pressure(124.5, 81.2, year=2021, month=1, day=1, hour=0, minute=3, patient_id=last_id, fernet=fernet)
     insert_pressure(134.5, 91.0, year=2021, month=3, day=17, hour=7, minute=50, patient_id=last_id, fernet=fernet)
 
-    conn.commit()
+    commit()
+
+
+MEASUREMENTS = ('Pressure', 'Temperature')
+STREAM_BATCH = 500  # rows fetched at once by iter_history()
+
+# per table: query of a patient's measurements (filters are appended), acquisition column, row -> response entry
+HISTORY_QUERIES = {'Pressure': ('''SELECT id, press_acquisition, systolic, diastolic, press_entry_timestamp
+                                  FROM Pressure WHERE patient_id=?''',
+                               'press_acquisition',
+                               lambda row: {'acquisition': row['press_acquisition'],
+                                            'systolic': row['systolic'],
+                                            'diastolic': row['diastolic'],
+                                            'entry_timestamp': row['press_entry_timestamp']}),
+                   'Temperature': ('''SELECT id, temp_acquisition, value, temp_entry_timestamp
+                                     FROM Temperature WHERE patient_id=?''',
+                                  'temp_acquisition',
+                                  lambda row: {'acquisition': row['temp_acquisition'],
+                                               'value': row['value'],
+                                               'entry_timestamp': row['temp_entry_timestamp']})}
+
+
+def encode_cursor(positions: dict) -> str:
+    """Opaque, URL safe pagination cursor: {table: [acquisition, id] of the last returned row or None if exhausted}"""
+    return base64.urlsafe_b64encode(json.dumps(positions, separators=(',', ':')).encode()).decode().rstrip('=')
+
 
+def decode_cursor(cursor: str) -> dict:
+    try:
+        positions = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        if isinstance(positions, dict) and all(
+                table in HISTORY_QUERIES and (position is None or (
+                    isinstance(position, list) and len(position) == 2 and
+                    isinstance(position[0], str) and isinstance(position[1], int)))
+                for table, position in positions.items()):
+            return positions
+    except (ValueError, TypeError):
+        pass
+    raise ValueError("Bad pagination cursor")
+
+
+def query_history(db_cursor, table: str, patient_id: int, since=None, until=None, after=None, limit=None):
+    """
+    Executes on db_cursor the query of `table` rows for the patient, newest first. since/until bound the acquisition
+    time (inclusive), `after` is the (acquisition, id) of the last row of the previous page (keyset pagination).
+    Needs `lock` to be held if db_cursor belongs to `conn`.
+    """
+    query, acquisition, _ = HISTORY_QUERIES[table]
+    params = [patient_id]
+    if since is not None:
+        query += f' AND {acquisition} >= ?'
+        params.append(since)
+    if until is not None:
+        query += f' AND {acquisition} <= ?'
+        params.append(until)
+    if after is not None:
+        query += f' AND ({acquisition} < ? OR ({acquisition} = ? AND id < ?))'
+        params += [after[0], after[0], after[1]]
+    query += f' ORDER BY {acquisition} DESC, id DESC'
+    if limit is not None:
+        query += ' LIMIT ?'
+        params.append(limit)
+    return db_cursor.execute(query, params)
 
-def get(patient_id: int, fernet):  # NOQA
-    cur.execute('''SELECT Patient.id, Patient.last_name, Patient.first_name, Patient.date_of_birth, Patient.registration_timestamp
-            FROM Patient WHERE Patient.id=?''', (patient_id,))
 
-    patient_row = cur.fetchone()
+def iter_history(table: str, patient_id: int, since=None, until=None, after=None, limit=None):
+    """Yields rows fetched in batches of STREAM_BATCH, a pooled connection is checked out until the generator ends."""
+    connection = pool.checkout()
+    history_cursor = connection.cursor()
+    try:
+        with metrics.phase('sql'):
+            query_history(history_cursor, table, patient_id, since, until, after, limit)
+            rows = history_cursor.fetchmany(STREAM_BATCH)
+        while rows:
+            yield from rows
+            with metrics.phase('sql'):
+                rows = history_cursor.fetchmany(STREAM_BATCH)
+    finally:
+        history_cursor.close()
+        pool.checkin(connection)
+
+
+def iter_get(patient_id: int, fernet, measurements=MEASUREMENTS, since=None, until=None, limit=None, cursor=None,
+             indent=4):
+    """
+    Patient's data with measurements from `measurements` tables as an iterator of JSON text chunks (None if there is
+    no such patient), rows are read from the database while the chunks are consumed. With `limit` at most that many
+    rows per table are returned together with 'next_cursor', which passed as `cursor` (decoded) continues from where
+    the page ended. indent=None gives compact JSON, otherwise the output equals json.dumps(..., indent=indent).
+    """
+    if limit is not None and limit < 1:
+        raise ValueError("limit must be a positive integer")
+    with pool.connection() as connection, metrics.phase('sql'):
+        patient_row = connection.execute('''SELECT Patient.id, Patient.last_name, Patient.first_name, Patient.date_of_birth, Patient.registration_timestamp
+                FROM Patient WHERE Patient.id=?''', (patient_id,)).fetchone()
+
     if patient_row is None:
-        print(f"Patient: {patient_id} not in register!")
+        log.warning(f"Patient: {patient_id} not in register!")
         return None
 
-    patient_dict = {"Patient": {'last_name': fernet.decrypt(patient_row['last_name']).decode(),
-                                'first_name': fernet.decrypt(patient_row['first_name']).decode(),
-                                'date_of_birth': fernet.decrypt(patient_row['date_of_birth']).decode(),
-                                'registration_timestamp': patient_row['registration_timestamp'],
-                                'Pressure': [],
-                                'Temperature': []}}
+    with metrics.phase('decrypt'):
+        patient = {'last_name': fernet.decrypt(patient_row['last_name']).decode(),
+                   'first_name': fernet.decrypt(patient_row['first_name']).decode(),
+                   'date_of_birth': fernet.decrypt(patient_row['date_of_birth']).decode(),
+                   'registration_timestamp': patient_row['registration_timestamp']}
 
-    cur.execute('''SELECT press_acquisition, systolic, diastolic, press_entry_timestamp
-            FROM Pressure WHERE patient_id=? ORDER BY press_acquisition DESC ''', (patient_id,))
+    if indent:
+        def dumps(value, level=0):
+            return json.dumps(value, indent=indent).replace('\n', '\n' + ' ' * (indent * level))
+
+        def newline(level):
+            return '\n' + ' ' * (indent * level)
+        colon = ': '
+    else:
+        def dumps(value, level=0):
+            return json.dumps(value, separators=(',', ':'))
 
-    for press_row in cur.fetchall():
-        patient_dict["Patient"]['Pressure'].append({'acquisition': press_row['press_acquisition'],
-                                                    'systolic': press_row['systolic'],
-                                                    'diastolic': press_row['diastolic'],
-                                                    'entry_timestamp': press_row['press_entry_timestamp']})
+        def newline(level):
+            return ''
+        colon = ':'
 
-    cur.execute('''SELECT temp_acquisition, value, temp_entry_timestamp
-                FROM Temperature WHERE patient_id=? ORDER BY temp_acquisition DESC''', (patient_id,))
+    def chunks():
+        yield '{' + newline(1) + '"Patient"' + colon + '{'
+        yield ','.join(newline(2) + dumps(key) + colon + dumps(value) for key, value in patient.items())
 
-    for temp_row in cur.fetchall():
-        patient_dict["Patient"]['Temperature'].append({'acquisition': temp_row['temp_acquisition'],
-                                                       'value': temp_row['value'],
-                                                       'entry_timestamp': temp_row['temp_entry_timestamp']})
+        next_positions = {}
+        for table in measurements:
+            _, acquisition, make_entry = HISTORY_QUERIES[table]
+            yield ',' + newline(2) + dumps(table) + colon + '['
+            next_positions[table] = None
+            if cursor is None or table not in cursor or cursor[table] is not None:
+                rows = iter_history(table, patient_id, since, until, cursor.get(table) if cursor else None,
+                                    None if limit is None else limit + 1)
+                separator = ''
+                last_row = None
+                for count, row in enumerate(rows):
+                    if count == limit:  # the extra row only tells that there is a next page
+                        next_positions[table] = [last_row[acquisition], last_row['id']]
+                        break
+                    yield separator + newline(3) + dumps(make_entry(row), 3)
+                    separator = ','
+                    last_row = row
+                rows.close()
+                if separator:
+                    yield newline(2)
+            yield ']'
 
-    return json.dumps(patient_dict, indent=4)
+        yield newline(1) + '}'
+        if limit is not None or cursor is not None:
+            next_cursor = encode_cursor(next_positions) if any(next_positions.values()) else None
+            yield ',' + newline(1) + '"next_cursor"' + colon + dumps(next_cursor)
+        yield newline(0) + '}'
 
+    return chunks()
 
-def connect(db_path):
-    global conn, cur
-    conn = sqlite3.connect(db_path)
+
+def get(patient_id: int, fernet, measurements=MEASUREMENTS, since=None, until=None, limit=None, cursor=None,
+        indent=4):
+    """Whole response of iter_get() as one string."""
+    chunks = iter_get(patient_id, fernet, measurements, since, until, limit, cursor, indent)
+    return None if chunks is None else ''.join(chunks)
+
+
+# statistics series: table, column, acquisition column
+STATS_SERIES = {'systolic': ('Pressure', 'systolic', 'press_acquisition'),
+                'diastolic': ('Pressure', 'diastolic', 'press_acquisition'),
+                'temperature': ('Temperature', 'value', 'temp_acquisition')}
+# bucket label of an acquisition timestamp: the day, the Monday starting the week or the month
+STATS_BUCKETS = {'day': "strftime('%Y-%m-%d', {})",
+                 'week': "date({}, 'weekday 0', '-6 days')",
+                 'month': "strftime('%Y-%m', {})"}
+STATS_AGGREGATES = {'count': 'COUNT(*)', 'mean': 'AVG(value)', 'min': 'MIN(value)', 'max': 'MAX(value)'}
+STATS_DEFAULT = ('count', 'mean', 'min', 'max')
+
+
+def parse_percentile(stat: str):
+    """Percentile of a 'pNN' statistic name (0 <= NN <= 100) or None if stat is not one."""
+    if stat[:1] == 'p' and stat[1:].isdigit() and 0 <= int(stat[1:]) <= 100:
+        return int(stat[1:])
+    return None
+
+
+def get_stats(patient_id: int, series=tuple(STATS_SERIES), bucket: str = 'day', stats=STATS_DEFAULT,
+              since=None, until=None) -> dict:
+    """
+    Per bucket statistics of the patient's measurements computed by SQLite: {series: [{'bucket': ..., stat: ...}]}
+    Stats are names from STATS_AGGREGATES or nearest-rank percentiles 'p0' .. 'p100' (e.g. p50, p95).
+    """
+    if bucket not in STATS_BUCKETS:
+        raise ValueError(f"Bucket must be one of: {', '.join(STATS_BUCKETS)}")
+    for name in series:
+        if name not in STATS_SERIES:
+            raise ValueError(f"Series must be one of: {', '.join(STATS_SERIES)}")
+    columns = []
+    for stat in stats:
+        percentile = parse_percentile(stat)
+        if stat in STATS_AGGREGATES:
+            columns.append(f'{STATS_AGGREGATES[stat]} AS {stat}')
+        elif percentile is not None:  # value of the ceil(percentile * n / 100)-th row of the bucket sorted by value
+            columns.append(f'MIN(CASE WHEN rank = MAX(1, ({percentile} * n + 99) / 100) THEN value END) AS {stat}')
+        else:
+            raise ValueError(f"Stats must be one of: {', '.join(STATS_AGGREGATES)} or percentiles p0 .. p100")
+    if not columns:
+        raise ValueError("No stats requested")
+
+    result = {}
+    for name in series:
+        table, column, acquisition = STATS_SERIES[name]
+        bucket_expr = STATS_BUCKETS[bucket].format(acquisition)
+        query = f'''SELECT {bucket_expr} AS bucket, {column} AS value,
+                   ROW_NUMBER() OVER (PARTITION BY {bucket_expr} ORDER BY {column}) AS rank,
+                   COUNT(*) OVER (PARTITION BY {bucket_expr}) AS n
+                   FROM {table} WHERE patient_id=?'''
+        params = [patient_id]
+        if since is not None:
+            query += f' AND {acquisition} >= ?'
+            params.append(since)
+        if until is not None:
+            query += f' AND {acquisition} <= ?'
+            params.append(until)
+        query = f'SELECT bucket, {", ".join(columns)} FROM ({query}) GROUP BY bucket ORDER BY bucket'
+
+        with pool.connection() as connection, metrics.phase('sql'):
+            result[name] = [dict(row) for row in connection.execute(query, params)]
+    return result
+
+
+def apply_profile(connection, profile: dict):
+    for pragma, value in profile.items():
+        if pragma not in CONNECTION_PROFILE:
+            raise ValueError(f"Unsupported pragma: {pragma}")
+        connection.execute(f"PRAGMA {pragma}={value}")
+
+
+def active_pragmas(connection) -> dict:
+    """Current values of the pragmas set by CONNECTION_PROFILE (enumerated ones as names, e.g. synchronous=NORMAL)."""
+    pragmas = {}
+    for pragma in CONNECTION_PROFILE:
+        value = connection.execute(f"PRAGMA {pragma}").fetchone()[0]
+        pragmas[pragma] = PRAGMA_NAMES.get(pragma, {}).get(value, value)
+    return pragmas
+
+
+def connect(db_path, profile: dict = None, readers: int = POOL_SIZE):
+    """
+    Opens the database with CONNECTION_PROFILE pragmas, entries of `profile` override them: the writer connection
+    `conn` (used under `lock`) and a pool of up to `readers` read-only connections.
+    """
+    global conn, cur, pool
+    conn = sqlite3.connect(db_path, check_same_thread=False)  # shared by the server's worker threads under `lock`
+    apply_profile(conn, {**CONNECTION_PROFILE, **(profile or {})})
     cur = conn.cursor()
     cur.row_factory = sqlite3.Row
+    pool = ConnectionPool(db_path, profile, readers)
     return conn
 
 
 def disconnect():
+    if pool is not None:
+        pool.close()
     conn.close()
 
 
-if cur.execute("SELECT COUNT(*) FROM Credentials").fetchone()[0] == 0:
-    fake_fill_db()
-    print("Database set up")
-
-conn.close()
+def initialize(db_path=MEDICAL_REGISTRY, seed_demo: bool = False):
+    """
+    Creates or migrates the database schema, with seed_demo fills an empty database with demo patients
+    (fake_fill_db). Has to be called once before the database is used, e.g. by the server before it forks workers.
+    """
+    enc.server_key()  # created here and not by the first requests of concurrently started worker processes
+    connect(db_path)
+    try:
+        with lock:
+            create_schema()
+            migrate()
+            if seed_demo and cur.execute("SELECT COUNT(*) FROM Credentials").fetchone()[0] == 0:
+                fake_fill_db()
+                print("Database set up")
+    finally:
+        disconnect()
 
 # if __name__ == '__main__':
 #     try:
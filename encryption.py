@@ -1,33 +1,361 @@
+import argparse
 import base64
+import hashlib
+import hmac
+import json
 import os
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
 from cryptography.fernet import Fernet
+import metrics
+
+try:
+    from cryptography.hazmat.primitives.kdf.argon2 import Argon2id
+except ImportError:  # cryptography < 44
+    Argon2id = None
 
 """Moduł użytkowy encryption.py udostępnia modułowi database.py funkcje wykonujące szyfrowanie danych pacjenta. 
-Do generacji klucza wykorzystywanego do szyfrowania i deszyfrowania danych wykorzystywane jest hasło pacjenta."""
+Dane pacjenta szyfrowane są losowym kluczem danych (new_data_key()), przechowywanym w bazie w postaci opakowanej
+(wrap_key()) kluczem wyprowadzonym z hasła pacjenta i indywidualnej, losowej soli (szyfrowanie kopertowe). Zmiana
+hasła wymaga jedynie ponownego opakowania klucza danych, a nie ponownego szyfrowania danych. Konta założone
+przed wprowadzeniem kluczy danych (klucz wyprowadzany z hasła i stałej soli `salt`) są przenoszone przy logowaniu -
+dotychczasowy klucz staje się ich kluczem danych.
+
+Funkcja wyprowadzająca klucz z hasła (KDFS: pbkdf2, scrypt, argon2id) i jej parametry zapisywane są przy każdym
+opakowanym kluczu, więc rekordy z różnymi parametrami współistnieją. Nowe klucze opakowywane są z parametrami
+z pliku KDF_CONFIG_FILE (domyślnie PBKDF2, 100 000 iteracji), który tworzy kalibracja na danym serwerze:
+
+    python encryption.py --calibrate --kdf scrypt --target-ms 100 [--max-memory-mb 64]
+
+Pamięć jednego wyprowadzenia scrypt (128 * r * n bajtów) nie przekracza --max-memory-mb, ponieważ równoległe
+logowania zajmują ją jednocześnie.
+
+Klucz opakowany słabszymi parametrami zostaje ponownie opakowany przy najbliższym logowaniu pacjenta.
+
+Wyprowadzenie klucza jest kosztowne, dlatego make_Fernet() korzysta z fernet_cache -
+ograniczonej (LRU, czas życia wpisu) pamięci podręcznej obiektów Fernet. Kluczem wpisu jest HMAC hasła z losową,
+generowaną przy starcie procesu solą, hasło w postaci jawnej nie jest przechowywane.
+
+Po zalogowaniu klient otrzymuje token sesji (issue_session_token()) - zaszyfrowany kluczem serwera i podpisany
+identyfikator pacjenta wraz z kluczem jego danych. Kolejne zapytania z tokenem nie wymagają wyprowadzania klucza
+z hasła, a jedynie weryfikacji HMAC i odszyfrowania tokenu."""
 
 
 salt = b'\xc8\tp\xcd\x11r3\x1f\x0c\xb92\x96)\xcc\xd9\xa3'
 
+SERVER_KEY_FILE = 'server.key'
+SERVER_KEY_ENV = 'MEDICAL_REGISTRY_SERVER_KEY'  # hex encoded, takes precedence over SERVER_KEY_FILE
+SERVER_KEY_SIZE = 32  # bytes
+
+SESSION_TTL = 900  # seconds a session token stays valid
+
+KDF_CONFIG_FILE = 'kdf.json'  # parameters of newly wrapped keys, written by `python encryption.py --calibrate`
+LEGACY_KDF_PARAMS = {'name': 'pbkdf2', 'iterations': 100000}  # keys derived before the parameters were stored
+CALIBRATION_MAX_MEMORY = 64 * 2 ** 20  # bytes one scrypt derivation may use, concurrent logins multiply it
+
+_server_key = None
+_server_key_lock = threading.Lock()
+_session_fernet = None
+_kdf_params = None
+
+
+def read_server_key(path: str) -> bytes:
+    with open(path, 'rb') as key_file:
+        key = key_file.read()
+    if len(key) != SERVER_KEY_SIZE:
+        raise ValueError(f"Server key {path} is damaged, expected {SERVER_KEY_SIZE} bytes")
+    return key
+
+
+def load_server_key(path: str = SERVER_KEY_FILE) -> bytes:
+    """
+    Server-side secret (not derived from any patient password), generated on first use if missing. The new key is
+    written to a temporary file and linked into place, so the file is never seen half written and a process that
+    loses the race for creating it reads the winner's key.
+    """
+    key_hex = os.environ.get(SERVER_KEY_ENV)
+    if key_hex:
+        return bytes.fromhex(key_hex)
+
+    try:
+        return read_server_key(path)
+    except FileNotFoundError:
+        pass
+    key = os.urandom(SERVER_KEY_SIZE)
+    fd, temp_path = tempfile.mkstemp(prefix='.server-key-', dir=os.path.dirname(os.path.abspath(path)))  # mode 0600
+    try:
+        with os.fdopen(fd, 'wb') as key_file:
+            key_file.write(key)
+            key_file.flush()
+            os.fsync(key_file.fileno())
+        os.link(temp_path, path)  # unlike os.replace() never overwrites a key created in the meantime
+    except FileExistsError:
+        return read_server_key(path)
+    finally:
+        os.unlink(temp_path)
+    return key
+
+
+def server_key() -> bytes:
+    """The key of load_server_key(), loaded once per process."""
+    global _server_key
+    if _server_key is None:
+        with _server_key_lock:
+            if _server_key is None:
+                _server_key = load_server_key()
+    return _server_key
+
+
+def server_subkey(label: bytes) -> bytes:
+    return hmac.new(server_key(), label, hashlib.sha256).digest()
+
+
+def username_digest(username: str) -> str:
+    """Deterministic, keyed digest of the username used as an indexed lookup key in Credentials."""
+    return hmac.new(server_subkey(b'credentials-username-lookup'), username.encode(), hashlib.sha256).hexdigest()
+
+
+class DataFernet(Fernet):
+    """Fernet that keeps its key, so the key can be handed over in a session token."""
+
+    def __init__(self, key: bytes):
+        super().__init__(key)
+        self.key = key
+
+
+def session_fernet() -> Fernet:
+    global _session_fernet
+    if _session_fernet is None:
+        _session_fernet = Fernet(base64.urlsafe_b64encode(server_subkey(b'session-token')))
+    return _session_fernet
+
+
+def issue_session_token(patient_id: int, fernet: DataFernet) -> str:
+    """URL safe token binding the patient id to the key of the patient's data, valid for SESSION_TTL seconds."""
+    payload = json.dumps({'patient_id': patient_id, 'key': fernet.key.decode()}).encode()
+    return session_fernet().encrypt(payload).decode()
+
+
+def open_session_token(token: str, ttl: float = None):
+    """(patient_id, fernet) of an issued token, raises cryptography.fernet.InvalidToken if forged or expired."""
+    payload = json.loads(session_fernet().decrypt(token.encode(), ttl=SESSION_TTL if ttl is None else ttl))
+    return payload['patient_id'], DataFernet(payload['key'].encode())
+
+
+def make_pbkdf2(kdf_salt: bytes, iterations: int):
+    return PBKDF2HMAC(algorithm=hashes.SHA256(), length=32, salt=kdf_salt, iterations=iterations,
+                      backend=default_backend())
+
+
+def make_scrypt(kdf_salt: bytes, n: int, r: int, p: int):
+    return Scrypt(salt=kdf_salt, length=32, n=n, r=r, p=p, backend=default_backend())
+
+
+def make_argon2id(kdf_salt: bytes, iterations: int, lanes: int, memory_cost: int):
+    return Argon2id(salt=kdf_salt, length=32, iterations=iterations, lanes=lanes, memory_cost=memory_cost)
+
 
-def make_kdf():
-    kdf = PBKDF2HMAC(
-        algorithm=hashes.SHA256(),
-        length=32,
-        salt=salt,
-        iterations=100000,
-        backend=default_backend()
-    )
-    return kdf
+KDFS = {'pbkdf2': make_pbkdf2, 'scrypt': make_scrypt}
+if Argon2id is not None:
+    KDFS['argon2id'] = make_argon2id
 
 
-def make_key(password: str) -> bytes:
-    kdf = make_kdf()
-    key = base64.urlsafe_b64encode(kdf.derive(password.encode()))
+def encode_kdf_params(params: dict) -> str:
+    return json.dumps(params, sort_keys=True, separators=(',', ':'))
+
+
+def decode_kdf_params(stored_params: str) -> dict:
+    """Parameters stored with a wrapped key, None (not stored) stands for LEGACY_KDF_PARAMS."""
+    return LEGACY_KDF_PARAMS if stored_params is None else json.loads(stored_params)
+
+
+def kdf_params() -> dict:
+    """Parameters of keys wrapped from now on: KDF_CONFIG_FILE if it exists, LEGACY_KDF_PARAMS otherwise."""
+    global _kdf_params
+    if _kdf_params is None:
+        try:
+            with open(KDF_CONFIG_FILE) as config_file:
+                params = json.load(config_file)
+        except FileNotFoundError:
+            params = LEGACY_KDF_PARAMS
+        if params.get('name') not in KDFS:
+            raise ValueError(f"Unsupported KDF in {KDF_CONFIG_FILE}: {params.get('name')}")
+        _kdf_params = params
+    return _kdf_params
+
+
+def set_kdf_config(path: str):
+    """Switches KDF_CONFIG_FILE, the parameters are read again on the next kdf_params() call."""
+    global KDF_CONFIG_FILE, _kdf_params
+    KDF_CONFIG_FILE = path
+    _kdf_params = None
+
+
+def make_kdf(kdf_salt: bytes = salt, params: dict = None):
+    params = dict(LEGACY_KDF_PARAMS if params is None else params)
+    return KDFS[params.pop('name')](kdf_salt, **params)
+
+
+def make_key(password: str, kdf_salt: bytes = salt, params: dict = None) -> bytes:
+    kdf = make_kdf(kdf_salt, params)
+    with metrics.phase('kdf'):
+        key = base64.urlsafe_b64encode(kdf.derive(password.encode()))
     return key
 
 
-def make_Fernet(password: str):
-    return Fernet(make_key(password))
+class FernetCache:
+    """Thread-safe LRU cache of derived Fernet objects with per-entry expiry and a cap on the number of entries."""
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 300.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # cache key -> (expires_at, fernet)
+        self._lock = threading.Lock()
+        self._key_salt = os.urandom(16)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def cache_key(self, password: str, kdf_salt: bytes = salt, params: dict = None) -> bytes:
+        kdf = encode_kdf_params(params).encode() if params is not None else b''
+        message = len(kdf_salt).to_bytes(2, 'big') + kdf_salt + len(kdf).to_bytes(2, 'big') + kdf + password.encode()
+        return hmac.new(self._key_salt, message, hashlib.sha256).digest()
+
+    def get(self, password: str, factory, kdf_salt: bytes = salt, params: dict = None):
+        """Returns the cached Fernet for password or stores the result of factory() (called without the lock held)."""
+        key = self.cache_key(password, kdf_salt, params)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self._entries[key]
+                self.expirations += 1
+            self.misses += 1
+
+        fernet = factory()
+
+        if self.max_entries > 0:
+            with self._lock:
+                self._entries[key] = (time.monotonic() + self.ttl, fernet)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+        return fernet
+
+    def invalidate(self, password: str, kdf_salt: bytes = salt, params: dict = None):
+        with self._lock:
+            self._entries.pop(self.cache_key(password, kdf_salt, params), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'entries': len(self._entries), 'max_entries': self.max_entries, 'hits': self.hits,
+                    'misses': self.misses, 'evictions': self.evictions, 'expirations': self.expirations}
+
+
+fernet_cache = FernetCache()
+
+
+def make_Fernet(password: str, kdf_salt: bytes = salt, params: dict = None):
+    return fernet_cache.get(password, lambda: DataFernet(make_key(password, kdf_salt, params)), kdf_salt, params)
+
+
+def invalidate_Fernet(password: str, kdf_salt: bytes = salt, params: dict = None):
+    """Drops the cached key for password, e.g. after the credential was changed or revoked."""
+    fernet_cache.invalidate(password, kdf_salt, params)
+
+
+def new_data_key() -> DataFernet:
+    """Random key encrypting one patient's data, stored only wrapped by wrap_key()."""
+    return DataFernet(Fernet.generate_key())
+
+
+def wrap_key(data_fernet: DataFernet, password: str):
+    """
+    (kdf_salt, kdf_params, wrapped_key) - the data key encrypted with the key derived from password by the KDF
+    of kdf_params() (stored encoded as kdf_params) and a fresh salt.
+    """
+    kdf_salt = os.urandom(16)
+    params = kdf_params()
+    return kdf_salt, encode_kdf_params(params), make_Fernet(password, kdf_salt, params).encrypt(data_fernet.key)
+
+
+def unwrap_key(password: str, kdf_salt: bytes, wrapped_key: bytes, stored_params: str = None) -> DataFernet:
+    """Data key of wrap_key() output, raises cryptography.fernet.InvalidToken if the password is wrong."""
+    return DataFernet(make_Fernet(password, kdf_salt, decode_kdf_params(stored_params)).decrypt(wrapped_key))
+
+
+def needs_rewrap(stored_params: str) -> bool:
+    """True if a key wrapped with stored_params should be wrapped again with the current kdf_params()."""
+    return decode_kdf_params(stored_params) != kdf_params()
+
+
+def time_kdf(params: dict, rounds: int = 3) -> float:
+    """Shortest of `rounds` derivations (seconds) with the given KDF parameters on this host."""
+    timings = []
+    for _ in range(rounds):
+        kdf = make_kdf(os.urandom(16), params)
+        start = time.perf_counter()
+        kdf.derive(b'calibration')
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def calibrate(name: str, target: float, max_memory: int = CALIBRATION_MAX_MEMORY) -> dict:
+    """
+    Strongest parameters of the KDF that derive a key within `target` seconds (scrypt: using at most `max_memory`
+    bytes) on this host, but never weaker than the baseline (PBKDF2: 100 000 iterations, scrypt: n=2**14, r=8, p=1,
+    Argon2id: 64 MiB, 4 lanes, 1 iteration).
+    """
+    if name == 'pbkdf2':
+        probe = {'name': 'pbkdf2', 'iterations': 20000}
+        iterations = int(probe['iterations'] * target / time_kdf(probe))  # cost is linear in iterations
+        return {'name': 'pbkdf2', 'iterations': max(iterations, LEGACY_KDF_PARAMS['iterations'])}
+    if name == 'scrypt':
+        params = {'name': 'scrypt', 'n': 2 ** 14, 'r': 8, 'p': 1}
+        # n must be a power of 2, memory is 128 * r * n
+        while (128 * params['r'] * params['n'] * 2 <= max_memory
+               and time_kdf(dict(params, n=params['n'] * 2)) <= target):
+            params['n'] *= 2
+        return params
+    if name == 'argon2id' and 'argon2id' in KDFS:
+        probe = {'name': 'argon2id', 'iterations': 1, 'lanes': 4, 'memory_cost': 64 * 1024}
+        return dict(probe, iterations=max(int(target / time_kdf(probe)), 1))
+    raise ValueError(f"Unsupported KDF: {name}, available: {', '.join(KDFS)}")
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='KDF calibration of the medical registry')
+    arg_parser.add_argument('--calibrate', action='store_true',
+                            help='measure the KDF on this host and write its parameters to --output')
+    arg_parser.add_argument('--kdf', default='pbkdf2', choices=sorted(KDFS))
+    arg_parser.add_argument('--target-ms', type=float, default=100.0, help='latency budget (ms) of one derivation')
+    arg_parser.add_argument('--max-memory-mb', type=float, default=CALIBRATION_MAX_MEMORY / 2 ** 20,
+                            help='memory budget (MiB) of one scrypt derivation')
+    arg_parser.add_argument('--output', default=KDF_CONFIG_FILE)
+    args = arg_parser.parse_args()
+
+    if not args.calibrate:
+        print(f"Current KDF parameters: {encode_kdf_params(kdf_params())}")
+        sys.exit(0)
+    params = calibrate(args.kdf, args.target_ms / 1000, int(args.max_memory_mb * 2 ** 20))
+    print(f"{encode_kdf_params(params)}: {time_kdf(params) * 1000:.1f} ms per derivation")
+    with open(args.output, 'w') as config_file:
+        json.dump(params, config_file)
+    print(f"Written to {args.output}, keys are rewrapped with these parameters on the patients' next login")
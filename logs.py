@@ -0,0 +1,121 @@
+import datetime
+import itertools
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+
+"""
+Moduł logs.py konfiguruje logowanie serwera (server.py): każdy wpis to jeden wiersz JSON, np.
+
+    {"time": "2021-12-12T22:10:00.123+00:00", "level": "INFO", "logger": "server", "message": "Request handled",
+     "request_id": "1f2a-3b", "method": "GET", "path": "/patient", "status": 200, "duration_ms": 12.5}
+
+Wątek obsługujący zapytanie jedynie wstawia wpis do kolejki (QueueHandler), formatowaniem i zapisem do strumienia
+zajmuje się osobny wątek (QueueListener), więc wolny terminal lub potok nie spowalnia obsługi zapytań. Gdy kolejka
+jest pełna (LOG_QUEUE_SIZE), wpis zostaje pominięty i policzony (dropped()) zamiast blokować wątek.
+
+Wpisy dotyczące zapytania (begin_request() .. end_request()) zawierają jego identyfikator request_id. Wpisy
+o poziomie niższym niż WARNING zapisywane są tylko dla części zapytań (sample_rate, server.py --log-sample),
+wybieranej losowo dla całego zapytania - z wybranego zapytania zapisywane są wszystkie wpisy.
+"""
+
+LOG_QUEUE_SIZE = 10000  # records waiting for the listener thread
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+_local = threading.local()
+_request_ids = itertools.count(1)
+_sample_rate = 1.0
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record, `extra` fields of the logging call become its keys."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {'time': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(
+                     timespec='milliseconds'),
+                 'level': record.levelname,
+                 'logger': record.name,
+                 'message': record.getMessage()}
+        entry.update((name, value) for name, value in vars(record).items() if name not in RECORD_ATTRIBUTES)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class RequestFilter(logging.Filter):
+    """Adds request_id of the request handled by this thread and drops records of requests left out of the sample."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        request_id = getattr(_local, 'request_id', None)
+        if request_id is None:
+            return True
+        record.request_id = request_id
+        return _local.sampled or record.levelno >= logging.WARNING
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # the listener runs in this process, the record doesn't have to be formatted (and pickled) before it's queued
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def begin_request():
+    _local.request_id = f'{os.getpid():x}-{next(_request_ids):x}'
+    _local.sampled = _sample_rate >= 1.0 or random.random() < _sample_rate
+
+
+def end_request():
+    _local.request_id = None
+
+
+def request_id():
+    return getattr(_local, 'request_id', None)
+
+
+def start(level=logging.INFO, sample_rate: float = 1.0, stream=sys.stdout):
+    """Routes the records of all loggers through a queue to `stream`, returns the listener to pass to stop()."""
+    global _sample_rate
+    _sample_rate = sample_rate
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    handler = NonBlockingQueueHandler(log_queue)
+    handler.addFilter(RequestFilter())
+
+    root = logging.getLogger()
+    for old_handler in root.handlers[:]:
+        root.removeHandler(old_handler)
+    root.addHandler(handler)
+    root.setLevel(level)
+
+    output = logging.StreamHandler(stream)
+    output.setFormatter(JsonFormatter())
+    listener = logging.handlers.QueueListener(log_queue, output)
+    listener.start()
+    return listener
+
+
+def stop(listener):
+    """Writes out the queued records and stops the listener thread."""
+    listener.stop()
+
+
+def dropped() -> int:
+    """Records dropped because the queue was full."""
+    return sum(handler.dropped for handler in logging.getLogger().handlers
+               if isinstance(handler, NonBlockingQueueHandler))
@@ -0,0 +1,154 @@
+import bisect
+import contextlib
+import logging
+import threading
+import time
+
+"""
+Moduł metrics.py zbiera metryki serwera (server.py) udostępniane w formacie tekstowym Prometheus pod ścieżką
+'/metrics':
+
+    > registry_requests_total{method, path, entry_type, status} - liczba obsłużonych zapytań
+    > registry_request_duration_seconds{method, path, entry_type, status} - histogram czasu obsługi zapytania
+    > registry_request_phase_seconds{phase} - histogram czasu spędzonego przez zapytanie w danej fazie
+
+Fazy (PHASES) mierzone są w miejscach ich wykonania (server.py, database.py, encryption.py) przez phase(), czas
+fazy dopisywany jest do zapytania obsługiwanego w bieżącym wątku (begin_request() .. end_request()). Fazy mogą się
+zawierać - auth obejmuje kdf i część sql. Zapytanie trwające co najmniej SLOW_REQUEST_THRESHOLD sekund zostaje
+zapisane w logu (logs.py) wraz z czasami faz (server.py --slow-request-ms). Każdy proces serwera (--processes) ma własne metryki.
+"""
+
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # seconds
+PHASES = ('recv', 'parse', 'auth', 'kdf', 'sql', 'commit', 'decrypt', 'send')
+SLOW_REQUEST_THRESHOLD = 0.0  # seconds, 0 disables the slow request log
+
+HELP = {'registry_requests_total': ('counter', 'Requests served'),
+        'registry_request_duration_seconds': ('histogram', 'Time from the first byte of a request to its response'),
+        'registry_request_phase_seconds': ('histogram', 'Time a request spent in one phase of its handling')}
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one counts values above the largest bucket
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry:
+    """Thread-safe counters and histograms keyed by metric name and labels (a tuple of (name, value) pairs)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+
+    def inc(self, name: str, labels: tuple = (), value: float = 1):
+        with self._lock:
+            self._counters[name, labels] = self._counters.get((name, labels), 0) + value
+
+    def observe(self, name: str, value: float, labels: tuple = ()):
+        with self._lock:
+            histogram = self._histograms.get((name, labels))
+            if histogram is None:
+                histogram = self._histograms[name, labels] = Histogram()
+            histogram.observe(value)
+
+    def render(self) -> str:
+        """Prometheus text exposition format (version 0.0.4)."""
+        lines = []
+        with self._lock:
+            for name in sorted({name for name, _ in self._counters} | {name for name, _ in self._histograms}):
+                kind, description = HELP.get(name, ('untyped', name))
+                lines += [f'# HELP {name} {description}', f'# TYPE {name} {kind}']
+                for (metric, labels), value in sorted(self._counters.items()):
+                    if metric == name:
+                        lines.append(f'{name}{format_labels(labels)} {value}')
+                for (metric, labels), histogram in sorted(self._histograms.items(), key=lambda item: item[0]):
+                    if metric != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{format_labels(labels + (("le", bound),))} {cumulative}')
+                    lines.append(f'{name}_sum{format_labels(labels)} {histogram.sum}')
+                    lines.append(f'{name}_count{format_labels(labels)} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels: tuple) -> str:
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+
+def render_gauges(prefix: str, values: dict) -> str:
+    """Extra gauges for the '/metrics' response, e.g. render_gauges('registry_fernet_cache', fernet_cache.stats())."""
+    return ''.join(f'# TYPE {prefix}_{name} gauge\n{prefix}_{name} {value}\n' for name, value in values.items())
+
+
+registry = Registry()
+log = logging.getLogger('metrics')
+_local = threading.local()
+
+
+class RequestTimer:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = {}  # phase -> seconds
+        self.status = 0
+
+
+def begin_request():
+    _local.request = RequestTimer()
+
+
+@contextlib.contextmanager
+def phase(name: str):
+    """Adds the time spent in the block to `name` phase of the request handled by this thread (if there is one)."""
+    request = getattr(_local, 'request', None)
+    if request is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        request.phases[name] = request.phases.get(name, 0.0) + time.perf_counter() - start
+
+
+def set_status(status: int):
+    request = getattr(_local, 'request', None)
+    if request is not None:
+        request.status = status
+
+
+def end_request(method: str, path: str, entry_type: str = ''):
+    """
+    Records the request handled by this thread, labels must come from a bounded set of values. Returns its
+    (status, seconds), None if no request was begun.
+    """
+    request = getattr(_local, 'request', None)
+    if request is None:
+        return None
+    _local.request = None
+    total = time.perf_counter() - request.start
+
+    labels = (('method', method), ('path', path), ('entry_type', entry_type), ('status', request.status))
+    registry.inc('registry_requests_total', labels)
+    registry.observe('registry_request_duration_seconds', total, labels)
+    for name, seconds in request.phases.items():
+        registry.observe('registry_request_phase_seconds', seconds, (('phase', name),))
+
+    if SLOW_REQUEST_THRESHOLD and total >= SLOW_REQUEST_THRESHOLD:
+        phases = {name: round(request.phases[name] * 1000, 3) for name in PHASES if name in request.phases}
+        log.warning('Slow request', extra={'method': method, 'path': path, 'entry_type': entry_type,
+                                           'status': request.status, 'duration_ms': round(total * 1000, 3),
+                                           'phases_ms': phases})
+    return request.status, total
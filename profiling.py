@@ -0,0 +1,114 @@
+import argparse
+import contextlib
+import cProfile
+import logging
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+
+"""
+Moduł profiling.py profiluje (cProfile) losowo wybraną część zapytań obsługiwanych przez serwer (server.py).
+
+Profilowanie jest domyślnie wyłączone (server.py --profile włącza je od startu), sygnał SIGUSR1 włącza je lub
+wyłącza w trakcie pracy serwera (przy --processes proces nadrzędny przekazuje sygnał procesom roboczym):
+
+    kill -USR1 <pid serwera>
+
+Gdy profilowanie jest wyłączone, koszt dla zapytania to jedno sprawdzenie zmiennej. Gdy jest włączone, profilowana
+jest część SAMPLE_RATE zapytań (--profile-sample), najwyżej jedno naraz w procesie. Profile zapytań są sumowane
+i co INTERVAL sekund (--profile-interval) oraz przy wyłączeniu profilowania zapisywane do katalogu PROFILE_DIR
+(--profile-dir) jako plik pstats: profile-<pid>-<czas>.pstats. Pliki można przeglądać modułem pstats, narzędziami
+takimi jak snakeviz lub gprof2dot, albo zsumować i wypisać skryptem:
+
+    python profiling.py profiles/*.pstats [--sort cumulative] [--limit 30]
+"""
+
+PROFILE_DIR = 'profiles'
+SAMPLE_RATE = 0.01  # fraction of requests profiled while profiling is enabled
+INTERVAL = 60.0  # seconds of aggregated profiles written to one file
+
+enabled = False
+log = logging.getLogger('profiling')
+_busy = threading.Lock()  # one profiled request at a time, Python 3.12+ allows a single active profiler
+_stats_lock = threading.Lock()
+_stats = None  # pstats.Stats of the requests profiled since the last dump
+_profiled = 0
+_last_dump = time.monotonic()
+
+
+@contextlib.contextmanager
+def profile_request():
+    """Profiles the block if profiling is enabled, the request is sampled and no other request is being profiled."""
+    if not enabled or random.random() >= SAMPLE_RATE or not _busy.acquire(blocking=False):
+        yield
+        return
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+    finally:
+        _busy.release()
+    add(profiler)
+
+
+def add(profiler):
+    global _stats, _profiled
+    with _stats_lock:
+        if _stats is None:
+            _stats = pstats.Stats(profiler)
+        else:
+            _stats.add(profiler)
+        _profiled += 1
+        if time.monotonic() - _last_dump >= INTERVAL:
+            _dump()
+
+
+def dump():
+    """Writes the profiles aggregated since the last dump (if there are any) to PROFILE_DIR."""
+    with _stats_lock:
+        _dump()
+
+
+def _dump():
+    global _stats, _profiled, _last_dump
+    _last_dump = time.monotonic()
+    if _stats is None:
+        return
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, f"profile-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}.pstats")
+    _stats.dump_stats(path)
+    log.info('Profile written', extra={'file': path, 'requests': _profiled})
+    _stats = None
+    _profiled = 0
+
+
+def toggle():
+    """Switches profiling on or off (SIGUSR1 of server.py), switching off writes what was collected."""
+    global enabled, _last_dump
+    enabled = not enabled
+    log.info('Profiling enabled' if enabled else 'Profiling disabled', extra={'sample_rate': SAMPLE_RATE})
+    if enabled:
+        _last_dump = time.monotonic()
+    else:
+        dump()
+
+
+def stats() -> dict:
+    return {'enabled': int(enabled), 'pending_requests': _profiled}
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Merge and print profiles written by the server')
+    arg_parser.add_argument('files', nargs='+', help='.pstats files from the --profile-dir of server.py')
+    arg_parser.add_argument('--sort', default='cumulative', help='pstats sort key, e.g. cumulative, tottime, calls')
+    arg_parser.add_argument('--limit', type=int, default=30, help='number of functions printed')
+    args = arg_parser.parse_args()
+
+    merged = pstats.Stats(*args.files, stream=sys.stdout)
+    merged.strip_dirs().sort_stats(args.sort).print_stats(args.limit)
@@ -1,10 +1,23 @@
+import argparse
+import itertools
 import json
+import logging
+import os
+import queue
+import selectors
+import signal
 import socket
 import sqlite3
 import sys
+import threading
+import time
 from urllib import parse
 import database as db
-import traceback
+import encryption as enc
+import logs
+import metrics
+import profiling
+from concurrent.futures import ThreadPoolExecutor
 
 """Moduł server.py pełni rolę serwera udostępniającego interfejs REST-API (metody 'GET' oraz 'POST') do 
 rejestru medycznego (bazy danych z pacjentami i pomiarami) zdefiniowanego w database.py.
@@ -14,10 +27,14 @@ Zaimplementowany interfejs umożliwia:
     > rejestrację nowego pacjenta (POST)
     > wprowadzenie do bazy wpisu dotyczącego pomiaru ciśnienia (POST)
     > wprowadzenie do bazy wpisu dotyczącego pomiaru temperatury (POST)
+    > odpytanie serwera o statystyki pomiarów pacjenta w przedziałach czasu (GET)
 
 
 Ścieżka (path) URL musi być:
     '/patient'
+    '/patient/stats' (tylko GET - statystyki pomiarów, patrz niżej)
+    '/login' (tylko POST - wydanie tokenu sesji, patrz niżej)
+    '/metrics' (bez autoryzacji - metryki serwera w formacie Prometheus, patrz metrics.py)
 
 Autoryzacja klienta:
     username i password przekazywane jako 'queries' w URL zapytania, np. dla:
@@ -28,6 +45,64 @@ Autoryzacja klienta:
     
     GET /patient?username=admin&password=12345 HTTP/1.1
 
+    Wartości 'queries' są dekodowane z kodowania procentowego (np. password=a%26b to hasło 'a&b').
+
+    Sprawdzenie hasła wymaga kosztownego wyprowadzenia klucza (PBKDF2), dlatego klient wykonujący wiele zapytań
+    może zalogować się raz:
+
+    POST /login?username=admin&password=12345 HTTP/1.1
+
+    {
+        "token": "gAAAAABh...",
+        "token_type": "Bearer",
+        "expires_in": 900
+    }
+
+    i w kolejnych zapytaniach (przez --session-ttl sekund) zamiast username i password przesyłać token w nagłówku
+    'Authorization: Bearer <token>' lub jako 'query' token=<token>.
+
+Metoda GET:
+    Zwraca dane pacjenta oraz jego pomiary (od najnowszych) w formacie JSON. Opcjonalne 'queries' w URL zawężają
+    odpowiedź:
+        > type - pressure, temperature lub all (domyślnie) - rodzaj zwracanych pomiarów
+        > from, to - zakres chwil pomiaru (włącznie) w formacie YYYY/MM/DD lub YYYY/MM/DD/hh/mm
+        > limit - maksymalna liczba pomiarów każdego rodzaju w odpowiedzi
+        > cursor - wartość 'next_cursor' z poprzedniej odpowiedzi, zwraca kolejną stronę pomiarów
+
+    Np. GET /patient?username=admin&password=12345&type=pressure&from=2021/01/01&limit=100 HTTP/1.1
+
+    Jeżeli podano limit lub cursor, odpowiedź zawiera 'next_cursor' (null, gdy nie ma kolejnych pomiarów).
+
+    Dodatkowe 'queries' określają postać odpowiedzi:
+        > compact=1 - JSON bez wcięć i znaków nowej linii (mniejsza odpowiedź)
+        > stream=1 - odpowiedź wysyłana jako 'Transfer-Encoding: chunked' w trakcie odczytu pomiarów z bazy danych,
+          bez budowania całej odpowiedzi w pamięci (zalecane dla długiej historii pomiarów)
+
+    Odpowiedzi GET /patient (bez stream=1) przechowywane są w pamięci podręcznej serwera (osobno dla każdego pacjenta
+    i zestawu 'queries', najdłużej do wprowadzenia nowego wpisu pacjenta, rozmiar --response-cache-mb) i zawierają
+    nagłówek 'ETag'. Klient, który prześle go z powrotem w nagłówku 'If-None-Match', otrzyma '304 Not Modified' bez
+    ciała odpowiedzi, jeżeli dane się nie zmieniły. Skuteczność pamięci podręcznej (registry_response_cache_hit_rate)
+    podaje GET /metrics.
+
+Statystyki pomiarów (GET /patient/stats):
+    Zwraca w formacie JSON statystyki pomiarów pacjenta w przedziałach czasu, obliczane przez bazę danych - zamiast
+    całej historii pomiarów odpowiedź zawiera kilka wartości na przedział. Opcjonalne 'queries' w URL:
+        > bucket - day (domyślnie), week lub month - długość przedziału (tydzień od poniedziałku)
+        > from, to - zakres chwil pomiaru (włącznie), jak dla GET /patient
+        > stats - lista statystyk oddzielonych przecinkami: count, mean, min, max (domyślnie wszystkie cztery) oraz
+          percentyle p0 .. p100 (np. p50, p95)
+        > series - lista serii oddzielonych przecinkami: systolic, diastolic, temperature (domyślnie wszystkie)
+        > compact=1 - JSON bez wcięć
+
+    Np. GET /patient/stats?username=admin&password=12345&bucket=week&stats=mean,min,max,p95&series=systolic HTTP/1.1
+
+    {
+        "systolic": [
+            {"bucket": "2021-12-06", "mean": 124.5, "min": 119.8, "max": 131.0, "p95": 130.2},
+            ...
+        ]
+    }
+
 Metoda POST:
     Dla metody 'POST' niezbędne jest przekazanie w nagłówku zapytania atrybutu 'entry_type' określającego typ wpisu, 
     który próbujemy wprowadzić do bazy danych (czy jest to pomiar ciśnienia, temperatury czy może nowy pacjent).
@@ -35,12 +110,19 @@ Metoda POST:
         > patient
         > pressure
         > temperature
+        > pressure_batch
+        > temperature_batch
+        > password
     
     W ciele zapytania należy umieścić również informacje w formacie JSON definiujące przekazywany wpis danego typu.
+    Długość ciała zapytania musi zostać określona nagłówkiem 'Content-Length' (lub ciało przesłane jako
+    'Transfer-Encoding: chunked'), w przeciwnym wypadku serwer odpowiada '411 Length Required'. Zbyt duże
+    nagłówki lub ciało zapytania (limity --max-header-size, --max-body-size) kończą się odpowiedzią 431 lub 413.
     Np. dla metody 'POST', username: srubka, password: gwint oraz content_type: pressure
     
     POST /patient?username=srubka&password=gwint HTTP/1.1
     entry_type: pressure
+    Content-Length: 90
     
     {
         "systolic": "120.0",
@@ -62,13 +144,99 @@ Metoda POST:
         "first_name": imie_pacjenta
         "date_of_birth": data urodzin w formacie YYYY/MM/DD
     }
+
+    Wpisy typu pressure_batch / temperature_batch pozwalają przesłać wiele pomiarów w jednym zapytaniu: ciało
+    zapytania to tablica JSON lub obiekty JSON rozdzielone znakiem nowej linii (NDJSON), każdy w formacie jak dla
+    pojedynczego wpisu pressure / temperature. Poprawne pomiary wprowadzane są do bazy w jednej transakcji,
+    odpowiedź (JSON) zawiera liczbę wprowadzonych i odrzuconych wpisów oraz status każdego z nich:
+
+    {
+        "entry_type": "pressure_batch",
+        "inserted": 1,
+        "rejected": 1,
+        "results": [{"index": 0, "status": "inserted", "id": 57},
+                    {"index": 1, "status": "rejected", "error": "Bad entry value: The timestamp is from the future"}]
+    }
+
+    Wpis typu password zmienia hasło pacjenta (wymaga username i password w URL, nie tokenu sesji):
+
+    {
+        "new_password": nowe_haslo
+    }
+
+    Dane pacjenta nie są ponownie szyfrowane - zmienia się tylko opakowanie jego klucza danych.
+
+    Wpisy patient, pressure, temperature oraz *_batch z 'query' compact=1 (np. POST /patient?token=...&compact=1)
+    zamiast powtórzenia przesłanego wpisu zwracają krótkie potwierdzenie JSON z identyfikatorem wprowadzonego
+    wiersza, np. {"entry_type": "pressure", "id": 123}, a dla *_batch listę identyfikatorów (null dla odrzuconych
+    wpisów) oraz błędy odrzuconych wpisów według ich indeksu.
+
+Połączenia trwałe:
+    Dla HTTP/1.1 połączenie pozostaje otwarte po odpowiedzi (chyba że klient wyśle 'Connection: close'), dla
+    HTTP/1.0 tylko po wysłaniu 'Connection: keep-alive'. Kolejne zapytania (również wysłane potokowo, bez czekania
+    na odpowiedź) obsługiwane są w kolejności nadejścia. Każda odpowiedź zawiera 'Content-Length'. Serwer zamyka
+    połączenie bezczynne dłużej niż --keep-alive-timeout sekund lub po --max-keep-alive-requests zapytaniach.
+    Połączenia czekające na kolejne zapytanie obserwuje wątek przyjmujący połączenia (selectors), więc nie zajmują
+    wątków roboczych (--workers).
+
+Uruchomienie:
+    python server.py [--address ADRES] [--port PORT] [--processes N] [--workers N] [--backlog N] [--seed-demo]
+
+    Przy starcie serwer tworzy brakujące tablice bazy danych (database.initialize), --seed-demo wprowadza do pustej
+    bazy danych testowych pacjentów (database.fake_fill_db).
+
+    Połączenia obsługiwane są równolegle przez pulę N wątków (--workers 0 - obsługa sekwencyjna w wątku
+    przyjmującym połączenia), --backlog określa długość kolejki połączeń oczekujących na accept().
+    --processes N uruchamia N procesów roboczych (pre-fork) współdzielących port serwera, każdy z własnym
+    połączeniem z bazą danych i własną pulą wątków. Proces nadrzędny wznawia procesy, które zakończyły się
+    nieoczekiwanie, a po SIGTERM/SIGINT kończy wszystkie po obsłużeniu bieżących zapytań.
+    --group-commit-ms T [--group-commit-batch N] włącza grupowe zatwierdzanie zapisów: zapisy z równoległych
+    zapytań czekają do T ms (lub do zebrania N zapisów) i zatwierdzane są jednym commitem, odpowiedź wysyłana jest
+    dopiero po zatwierdzeniu transakcji zawierającej dany zapis.
+    Połączenie z bazą danych otwierane jest z ustawieniami database.CONNECTION_PROFILE (m.in. WAL,
+    synchronous=NORMAL, mmap_size, cache_size), pojedyncze pragmy można nadpisać opcją --pragma NAZWA=WARTOŚĆ.
+    Aktywne wartości wypisywane są przy starcie serwera. Zapisy wykonywane są przez jedno połączenie, odczyty przez
+    pulę połączeń tylko do odczytu (po jednym na wątek roboczy), więc nie czekają na zapisy ani na siebie nawzajem.
+    Każde obsłużone zapytanie zapisywane jest w logu (stdout, wiersze JSON, patrz logs.py) wraz z identyfikatorem
+    request_id, statusem i czasem obsługi. --log-level określa najniższy zapisywany poziom, --log-sample R zapisuje
+    wpisy poniżej WARNING tylko dla losowo wybranej części R zapytań (np. 0.01).
+    --slow-request-ms T zapisuje w logu zapytania obsługiwane dłużej niż T ms wraz z czasem poszczególnych faz
+    (odbiór, parsowanie, autoryzacja, wyprowadzenie klucza, SQL, zatwierdzenie, deszyfrowanie, wysyłka).
+    --response-cache-mb M określa pamięć na odpowiedzi GET /patient przechowywane (osobno dla każdego pacjenta
+    i zestawu 'queries') do czasu wprowadzenia nowego wpisu pacjenta, 0 wyłącza pamięć podręczną (wyłączona zawsze
+    przy --processes).
+    --fernet-cache-size N określa liczbę kluczy wyprowadzonych z haseł przechowywanych w encryption.fernet_cache,
+    0 wyłącza pamięć podręczną (każde logowanie wyprowadza klucz, np. do pomiaru kosztu KDF).
+    --profile włącza profilowanie (cProfile) części --profile-sample zapytań, sygnał SIGUSR1 włącza je lub wyłącza
+    w trakcie pracy serwera. Zsumowane profile zapisywane są co --profile-interval sekund do katalogu --profile-dir
+    (patrz profiling.py).
+    --kdf-config PLIK wskazuje plik z parametrami wyprowadzania klucza z hasła (domyślnie encryption.KDF_CONFIG_FILE),
+    utworzony kalibracją na danym serwerze: python encryption.py --calibrate --kdf scrypt --target-ms 100
 """
 
 SERVER_ADDRESS = 'localhost'
 SERVER_PORT = 9000
+PROCESSES = 0
+WORKERS = 8
+BACKLOG = 128
+RESPAWN_DELAY = 1.0  # seconds
+MAX_HEADER_SIZE = 16 * 1024  # bytes, request line + headers
+MAX_BODY_SIZE = 16 * 1024 * 1024  # bytes
+RECV_SIZE = 64 * 1024
+STREAM_CHUNK_SIZE = 64 * 1024  # bytes of a streamed response collected before they are sent as one chunk
+KEEP_ALIVE_TIMEOUT = 5.0  # seconds a connection may stay idle between requests
+MAX_KEEP_ALIVE_REQUESTS = 100  # requests served on one connection before it is closed
+GROUP_COMMIT_LATENCY = 0.0  # seconds a write may wait to share a commit with others, 0 commits every write at once
+GROUP_COMMIT_BATCH = 64  # writes that trigger a group commit without waiting for GROUP_COMMIT_LATENCY
+SQLITE_PRAGMAS = {}  # overrides of db.CONNECTION_PROFILE
+LOG_LEVEL = logging.INFO
+LOG_SAMPLE_RATE = 1.0  # fraction of requests whose records below WARNING are logged
+ENTRY_TYPES = ('patient', 'pressure', 'temperature', 'pressure_batch', 'temperature_batch', 'password')
 
 response_dict = {'ok_plain': 'HTTP/1.1 200 OK\r\nContent-type: text/plain\r\n',
-                 'ok_json': 'HTTP/1.1 200 OK\r\nContent-Type : application/json\r\n',
+                 'ok_json': 'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n',
+                 'ok_metrics': 'HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n',
+                 'not_modified': 'HTTP/1.1 304 Not Modified\r\n',
                  'access_denied': 'HTTP/1.1 401 Unauthorized\r\nContent-type: text/plain\r\n\r\nAccess denied!\nInvalid username or password\r\n',
                  'already_registered': 'HTTP/1.1 403 Forbidden\r\nContent-type: text/plain\r\n\r\nPatient already registered\r\n',
                  'bad_request_method': 'HTTP/1.1 400 Bad Request\r\nContent-type: text/plain\r\n\r\nBad request method, try GET or POST\r\n',
@@ -77,7 +245,13 @@ response_dict = {'ok_plain': 'HTTP/1.1 200 OK\r\nContent-type: text/plain\r\n',
                  'missing_entry_value': 'HTTP/1.1 400 Bad Request\r\nContent-type: text/plain\r\n\r\nAt least one of entry values is missing\r\n',
                  'bad_entry_value': 'HTTP/1.1 400 Bad Request\r\nContent-type: text/plain\r\n\r\nAt least one of entry values is bad\r\n',
                  'bad_request_path': 'HTTP/1.1 400 Bad Request\r\nContent-type: text/plain\r\n\r\nBad request url path\r\n',
-                 'bad_request': 'HTTP/1.1 400 Bad Request\r\nContent-type: text/plain\r\n\r\nBad request url\r\n'
+                 'bad_request': 'HTTP/1.1 400 Bad Request\r\nContent-type: text/plain\r\n\r\nBad request url\r\n',
+                 'bad_query': 'HTTP/1.1 400 Bad Request\r\nContent-type: text/plain\r\n\r\nBad request url query value\r\n',
+                 'length_required': 'HTTP/1.1 411 Length Required\r\nContent-type: text/plain\r\n\r\nMissing \'Content-Length\' header\r\n',
+                 'payload_too_large': 'HTTP/1.1 413 Payload Too Large\r\nContent-type: text/plain\r\n\r\nRequest body too large\r\n',
+                 'headers_too_large': 'HTTP/1.1 431 Request Header Fields Too Large\r\nContent-type: text/plain\r\n\r\nRequest headers too large\r\n',
+                 'database_unavailable': 'HTTP/1.1 503 Service Unavailable\r\nContent-type: text/plain\r\n\r\nDatabase unavailable, try again later\r\n',
+                 'server_error': 'HTTP/1.1 500 Internal Server Error\r\nContent-type: text/plain\r\n\r\nInternal server error\r\n'
                  }
 
 
@@ -97,30 +271,126 @@ class UnsupportedMethodException(HTTPRequestException):
     pass
 
 
-def success_message(message):
-    print("SUCCESS", 50 * "-", message, 50 * "-", sep="\n")
+class LengthRequiredException(HTTPRequestException):
+    pass
+
+
+class PayloadTooLargeException(HTTPRequestException):
+    pass
 
 
-def error_message(message):
-    print("ERROR", 50 * "^", message, 50 * "v", sep="\n")
+class HeadersTooLargeException(HTTPRequestException):
+    pass
 
 
-def error_shutdown_connection(ex: Exception, connection, response: str):
+log = logging.getLogger('server')
+
+
+def success_message(message):
+    log.info(message)
+
+
+def error_message(ex: Exception):
+    log.warning(str(ex), extra={'error': type(ex).__name__})
+
+
+class ResponseTemplate:
+    """A response_dict entry split into pre-encoded parts, completed by send_response() / send_chunked()."""
+
+    def __init__(self, response: str):
+        head, separator, fixed_body = response.partition('\r\n\r\n')
+        if not separator:  # 'ok_*' entries end right after their headers
+            head = response.rstrip('\r\n')
+        self.status = int(head[9:12])  # 'HTTP/1.1 200 OK...'
+        self.head = head.encode()
+        self.body = fixed_body.encode()
+
+
+response_templates = {response: ResponseTemplate(response) for response in response_dict.values()}
+CONNECTION_HEADERS = {True: b'\r\nConnection: keep-alive\r\n\r\n', False: b'\r\nConnection: close\r\n\r\n'}
+
+
+def send_buffers(connection, buffers):
+    """sendall() of several buffers with sendmsg() (scatter/gather), without joining them into one first."""
+    buffers = [memoryview(buffer) for buffer in buffers if buffer]
+    if not hasattr(connection, 'sendmsg'):
+        connection.sendall(b''.join(buffers))
+        return
+    while buffers:
+        sent = connection.sendmsg(buffers)
+        while sent:  # drop what was sent, a partial send leaves the rest of a buffer
+            if sent >= len(buffers[0]):
+                sent -= len(buffers.pop(0))
+            else:
+                buffers[0] = buffers[0][sent:]
+                sent = 0
+
+
+def send_response(connection, response: str, body='', keep_alive: bool = False, extra_headers: bytes = b''):
+    """
+    Sends a response_dict entry with an optional body (str or bytes), 'Content-Length' and 'Connection' headers.
+    extra_headers are added as they are, each preceded by CRLF.
+    """
+    template = response_templates.get(response) or ResponseTemplate(response)
+    metrics.set_status(template.status)
+    if isinstance(body, str):
+        body = body.encode()
+    head = template.head + extra_headers
+    if template.status != 304:  # a 304 response has no body, its Content-Length would describe the 200 one
+        head += b'\r\nContent-Length: %d' % (len(template.body) + len(body))
+    head += CONNECTION_HEADERS[keep_alive]
+    with metrics.phase('send'):
+        send_buffers(connection, (head, template.body, body))
+
+
+def send_chunked(connection, response: str, chunks, keep_alive: bool = False):
+    """Sends a response_dict 'ok_*' entry followed by the text chunks as a 'Transfer-Encoding: chunked' body."""
+    template = response_templates.get(response) or ResponseTemplate(response)
+    metrics.set_status(template.status)
+    with metrics.phase('send'):
+        connection.sendall(template.head + b'\r\nTransfer-Encoding: chunked' + CONNECTION_HEADERS[keep_alive])
+
+    buffer = []
+    size = 0
+    for chunk in chunks:
+        data = chunk.encode()
+        buffer.append(data)
+        size += len(data)
+        if size >= STREAM_CHUNK_SIZE:
+            with metrics.phase('send'):
+                send_buffers(connection, (b'%x\r\n' % size, b''.join(buffer), b'\r\n'))
+            buffer = []
+            size = 0
+    with metrics.phase('send'):
+        send_buffers(connection, (b'%x\r\n' % size, b''.join(buffer), b'\r\n0\r\n\r\n') if size else (b'0\r\n\r\n',))
+
+
+def error_response(ex: Exception, connection, response: str, keep_alive: bool):
+    send_response(connection, response, keep_alive=keep_alive)
     error_message(ex)
-    connection.sendall(response.encode())
+
+
+def error_shutdown_connection(ex: Exception, connection, response: str):
+    error_response(ex, connection, response, keep_alive=False)
     connection.shutdown(socket.SHUT_WR)
+    finish_request('invalid', 'invalid')  # the request couldn't be parsed, its method and path are unknown
 
 
-def parse_request(req):
-    try:
-        headers_raw, body_raw = req.split('\r\n\r\n')
-    except ValueError:
-        raise HTTPRequestException("Bad request")
+def finish_request(method: str, path: str, entry_type: str = ''):
+    """Records the metrics and the access log entry of the request handled by this thread."""
+    finished = metrics.end_request(method, path, entry_type)
+    if finished is not None:
+        status, seconds = finished
+        log.info('Request handled', extra={'method': method, 'path': path, 'entry_type': entry_type,
+                                           'status': status, 'duration_ms': round(seconds * 1000, 3)})
+    logs.end_request()
 
-    first_line, *headers_rest = headers_raw.split('\r\n')
+
+def parse_head(head: str):
+    first_line, *headers_rest = head.split('\r\n')
     first_line_split = first_line.split(" ")
 
-    if len(first_line_split) < 1:
+    if len(first_line_split) < 2:
         raise HTTPRequestException("Bad request")
 
     req_method = first_line_split[0]
@@ -133,177 +403,860 @@ def parse_request(req):
     if path == '/favicon.ico':
         raise FaviconRequestException()
 
-    if not (path == '/patient'):
+    if path not in ('/patient', '/patient/stats', '/login', '/metrics'):
         raise InvalidRequestPathException(f"Invalid request path: {path}")
 
-    query = urlParsed.query.split("&")
-
-    try:
-        query_dict = {pair.split("=")[0]: pair.split("=")[1] for pair in query}
-        if 'username' not in query_dict or 'password' not in query_dict:
+    query_dict = {}
+    for pair in urlParsed.query.split("&"):
+        if not pair:
+            continue
+        name, separator, value = pair.partition("=")
+        if not separator:
             raise HTTPRequestException('Missing username and/or password in request URL queries')
-    except IndexError:
+        query_dict[parse.unquote(name)] = parse.unquote(value)  # '+' stays '+', passwords may contain it
+
+    headers = {}
+    for elem in headers_rest:
+        name, separator, value = elem.partition(':')
+        if not separator:
+            raise HTTPRequestException('Bad request')
+        headers[name.strip().lower()] = value.strip()
+
+    if path != '/metrics' and session_token(query_dict, headers) is None and (
+            'username' not in query_dict or 'password' not in query_dict):
         raise HTTPRequestException('Missing username and/or password in request URL queries')
 
-    try:
-        headers_tmp = [tuple(map(str.strip, elem.split(':'))) for elem in headers_rest]
-        headers = {header[0].lower(): header[1].strip() for header in headers_tmp}
-    except IndexError:
-        raise HTTPRequestException('Bad request')
+    version = first_line_split[2] if len(first_line_split) > 2 else 'HTTP/1.0'
+
+    return req_method, path, query_dict, headers, version
+
+
+def session_token(query_dict: dict, headers: dict):
+    """Session token from an 'Authorization: Bearer' header or a 'token' query, None if there is none."""
+    scheme, _, credentials = headers.get('authorization', '').partition(' ')
+    if scheme.lower() == 'bearer' and credentials.strip():
+        return credentials.strip()
+    return query_dict.get('token') or None
+
+
+def parse_measurement(entry_type: str, entry_dict: dict) -> dict:
+    """Converts a 'pressure' or 'temperature' entry from a request body to keyword arguments of db.insert_*."""
+    acquisition = entry_dict['acquisition'].split('/')
+    if len(acquisition) != 5:
+        raise ValueError("Acquisition timestamp must be in format YYYY/MM/DD/hh/mm")
+    measurement = {unit: int(value.strip()) for unit, value in
+                   zip(["year", "month", "day", "hour", "minute"], acquisition)}
+
+    if entry_type == 'pressure':
+        measurement['systolic'] = float(entry_dict['systolic'])
+        measurement['diastolic'] = float(entry_dict['diastolic'])
+    else:
+        measurement['value'] = float(entry_dict['value'])
+    return measurement
+
+
+def parse_query_timestamp(value: str, end_of_day: bool = False):
+    parts = [int(part) for part in value.split('/')]
+    if len(parts) == 3:
+        return sqlite3.Timestamp(*parts, 23, 59, 59) if end_of_day else sqlite3.Timestamp(*parts)
+    if len(parts) == 5:
+        return sqlite3.Timestamp(*parts)
+    raise ValueError("Timestamp must be in format YYYY/MM/DD or YYYY/MM/DD/hh/mm")
+
+
+def parse_history_query(query_dict: dict) -> dict:
+    """Keyword arguments of db.get from optional 'GET' queries: type, from, to, limit, cursor and compact."""
+    history_query = {}
+    if 'type' in query_dict:
+        measurements = {'pressure': ('Pressure',), 'temperature': ('Temperature',), 'all': db.MEASUREMENTS}
+        try:
+            history_query['measurements'] = measurements[query_dict['type'].lower()]
+        except KeyError:
+            raise ValueError("Query 'type' must be one of: pressure, temperature, all")
+    if 'from' in query_dict:
+        history_query['since'] = parse_query_timestamp(query_dict['from'])
+    if 'to' in query_dict:
+        history_query['until'] = parse_query_timestamp(query_dict['to'], end_of_day=True)
+    if 'limit' in query_dict:
+        history_query['limit'] = int(query_dict['limit'])
+        if history_query['limit'] < 1:
+            raise ValueError("Query 'limit' must be a positive integer")
+    if 'cursor' in query_dict:
+        history_query['cursor'] = db.decode_cursor(query_dict['cursor'])
+    if query_flag(query_dict, 'compact'):
+        history_query['indent'] = None
+    return history_query
+
+
+def etag_matches(if_none_match, etag: str) -> bool:
+    """Whether an 'If-None-Match' header value (None if missing) matches etag, weak comparison as in RFC 9110."""
+    if if_none_match is None:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    return etag in (tag.strip().removeprefix('W/') for tag in if_none_match.split(','))
+
+
+def query_flag(query_dict: dict, name: str) -> bool:
+    value = query_dict.get(name, '0').lower()
+    if value not in ('0', '1', 'false', 'true'):
+        raise ValueError(f"Query '{name}' must be one of: 0, 1, false, true")
+    return value in ('1', 'true')
+
+
+def parse_stats_query(query_dict: dict) -> dict:
+    """Keyword arguments of db.get_stats from optional 'GET /patient/stats' queries: bucket, from, to, stats, series."""
+    stats_query = {}
+    if 'bucket' in query_dict:
+        stats_query['bucket'] = query_dict['bucket'].lower()
+    if 'from' in query_dict:
+        stats_query['since'] = parse_query_timestamp(query_dict['from'])
+    if 'to' in query_dict:
+        stats_query['until'] = parse_query_timestamp(query_dict['to'], end_of_day=True)
+    if 'stats' in query_dict:
+        stats_query['stats'] = tuple(stat.strip().lower() for stat in query_dict['stats'].split(',') if stat.strip())
+    if 'series' in query_dict:
+        stats_query['series'] = tuple(name.strip().lower() for name in query_dict['series'].split(',') if name.strip())
+    return stats_query
+
+
+def parse_batch(body_raw: str) -> list:
+    """Entries of a '*_batch' request body: a JSON array or newline delimited JSON objects (NDJSON)."""
+    body = body_raw.strip()
+    if body.startswith('['):
+        entries = json.loads(body)
+    else:
+        entries = [json.loads(line) for line in body.splitlines() if line.strip()]
+    if not all(isinstance(entry, dict) for entry in entries):
+        raise ValueError("Every batch entry must be a JSON object")
+    return entries
+
+
+class RequestReader:
+    """
+    Reads HTTP requests from a connection incrementally. The body is framed by 'Content-Length' or
+    'Transfer-Encoding: chunked', bytes received past the end of a request stay buffered for the next one
+    (pipelined requests are read one after another from the same reader).
+    """
+
+    def __init__(self, connection, max_header_size=None, max_body_size=None):
+        self.connection = connection
+        self.max_header_size = MAX_HEADER_SIZE if max_header_size is None else max_header_size
+        self.max_body_size = MAX_BODY_SIZE if max_body_size is None else max_body_size
+        self.buffer = bytearray()
+        self.keep_alive = False  # whether the client asked to keep the connection open after the last request
+        self.requests = 0  # requests read from the connection
+
+    def _fill(self) -> bool:
+        data = self.connection.recv(RECV_SIZE)
+        self.buffer += data
+        return bool(data)
+
+    def _read_until(self, delimiter: bytes, limit: int, too_large: type):
+        searched = 0
+        while True:
+            end = self.buffer.find(delimiter, searched)
+            if end >= 0:
+                data = bytes(self.buffer[:end])
+                del self.buffer[:end + len(delimiter)]
+                return data
+            if len(self.buffer) > limit:
+                raise too_large("Request headers too large")
+            searched = max(0, len(self.buffer) - len(delimiter) + 1)
+            if not self._fill():
+                raise HTTPRequestException("Connection closed in the middle of the request")
+
+    def _read_exact(self, size: int) -> bytes:
+        while len(self.buffer) < size:
+            if not self._fill():
+                raise HTTPRequestException("Connection closed in the middle of the request")
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def _read_chunked(self) -> bytes:
+        body = bytearray()
+        while True:
+            size_line = self._read_until(b'\r\n', self.max_header_size, HeadersTooLargeException)
+            try:
+                size = int(size_line.split(b';')[0].strip(), 16)
+            except ValueError:
+                raise HTTPRequestException("Bad chunk size")
+            if size == 0:
+                while self._read_until(b'\r\n', self.max_header_size, HeadersTooLargeException):
+                    pass  # trailer fields are ignored
+                return bytes(body)
+            if len(body) + size > self.max_body_size:
+                raise PayloadTooLargeException("Request body too large")
+            body += self._read_exact(size)
+            if self._read_exact(2) != b'\r\n':
+                raise HTTPRequestException("Bad chunk framing")
+
+    def read_request(self):
+        """Returns (req_method, path, query_dict, headers, body_raw) or None if the client closed the connection."""
+        if not self.buffer and not self._fill():
+            return None
+        metrics.begin_request()  # waiting for the first byte of a request is not a part of it
+        logs.begin_request()
+        with metrics.phase('recv'):
+            head = self._read_until(b'\r\n\r\n', self.max_header_size, HeadersTooLargeException)
+        if len(head) > self.max_header_size:
+            raise HeadersTooLargeException("Request headers too large")
+
+        try:
+            head = head.decode()
+        except UnicodeDecodeError:
+            raise HTTPRequestException("Request head is not valid UTF-8")
+        with metrics.phase('parse'):
+            req_method, path, query_dict, headers, version = parse_head(head)
+        connection_options = headers.get('connection', '').lower()
+        if version == 'HTTP/1.1':
+            self.keep_alive = 'close' not in connection_options
+        else:
+            self.keep_alive = 'keep-alive' in connection_options
+
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            with metrics.phase('recv'):
+                body = self._read_chunked()
+        elif 'content-length' in headers:
+            # int() would also take '+10', '1_0' or non-ASCII digits, isdigit() alone takes '²'
+            if not (headers['content-length'].isascii() and headers['content-length'].isdigit()):
+                raise HTTPRequestException("Bad 'Content-Length' header")
+            length = int(headers['content-length'])
+            if length > self.max_body_size:
+                raise PayloadTooLargeException("Request body too large")
+            with metrics.phase('recv'):
+                body = self._read_exact(length)
+        elif req_method == 'POST':
+            raise LengthRequiredException("Missing 'Content-Length' header")
+        else:
+            body = b''
+
+        try:
+            return req_method, path, query_dict, headers, body.decode()
+        except UnicodeDecodeError:
+            raise HTTPRequestException("Request body is not valid UTF-8")
+
+
+def handle_connection(reader: RequestReader, address) -> bool:
+    """
+    Serves the requests of a connection with data to read. Returns True if the connection stays open and waits for the
+    next request (see ConnectionMonitor), False once the client closed it, asked to close it or stalled.
+    """
+    connection = reader.connection
+    connection.settimeout(KEEP_ALIVE_TIMEOUT)
+    while True:
+        try:
+            request = reader.read_request()
+            if request is None:
+                return False
+
+        except socket.timeout:
+            return False  # a stalled client
+
+        except FaviconRequestException:
+            connection.shutdown(socket.SHUT_RDWR)  # ignore favicon.ico request from browser
+            return False
+
+        except InvalidRequestPathException as ex:
+            error_shutdown_connection(ex, connection, response_dict['bad_request_path'])
+            return False
+
+        except UnsupportedMethodException as ex:
+            error_shutdown_connection(ex, connection, response_dict['bad_request_method'])
+            return False
+
+        except LengthRequiredException as ex:
+            error_shutdown_connection(ex, connection, response_dict['length_required'])
+            return False
+
+        except PayloadTooLargeException as ex:
+            error_shutdown_connection(ex, connection, response_dict['payload_too_large'])
+            return False
+
+        except HeadersTooLargeException as ex:
+            error_shutdown_connection(ex, connection, response_dict['headers_too_large'])
+            return False
+
+        except HTTPRequestException as ex:
+            error_shutdown_connection(ex, connection, response_dict['bad_request'])
+            return False
+
+        reader.requests += 1
+        keep_alive = reader.keep_alive and reader.requests < MAX_KEEP_ALIVE_REQUESTS
+        req_method, path, _, headers, _ = request
+        entry_type = headers.get('entry_type', '').lower()
+        try:
+            with profiling.profile_request():
+                handle_request(connection, request, keep_alive)
+        except Exception:
+            # the client gets a 500 instead of a connection closed without a reply, and the error is counted
+            log.exception('Error while handling request', extra={'client': f'{address[0]}:{address[1]}'})
+            keep_alive = False
+            try:
+                send_response(connection, response_dict['server_error'])
+            except OSError:
+                pass
+        finally:
+            finish_request(req_method, path, entry_type if entry_type in ENTRY_TYPES or not entry_type else 'other')
+        if not keep_alive:
+            connection.shutdown(socket.SHUT_WR)
+            return False
+        if not reader.buffer:
+            return True  # no pipelined request, wait for the next one without holding a worker
 
-    return req_method, path, query_dict, headers, body_raw
 
+def handle_request(connection, request, keep_alive: bool):
+    req_method, path, query_dict, headers, body_raw = request
+
+    if path == '/metrics':  # no credentials needed, contains no patient data
+        body = (metrics.registry.render() + metrics.render_gauges('registry_fernet_cache', enc.fernet_cache.stats())
+                + metrics.render_gauges('registry_log', {'dropped': logs.dropped()})
+                + metrics.render_gauges('registry_profiling', profiling.stats())
+                + metrics.render_gauges('registry_response_cache', db.response_cache.stats()))
+        send_response(connection, response_dict['ok_metrics'], body, keep_alive)
+        return
+
+    username = query_dict.get('username', '')
+    password = query_dict.get('password', '')
+    token = session_token(query_dict, headers)
 
-def create_server():
-    serverSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    conn = db.connect(db.MEDICAL_REGISTRY)
     try:
-        serverSocket.bind((SERVER_ADDRESS, SERVER_PORT))
-        serverSocket.listen(5)
-        while True:
-            print('\nready...\n')
-            (connection, address) = serverSocket.accept()
-            req = connection.recv(4096).decode()
 
-            try:
-                req_method, path, query_dict, headers, body_raw = parse_request(req)
+        with metrics.phase('auth'):
+            if token is not None:  # no key derivation, the token carries the key of the patient's data
+                patient_id, fernet = db.validate_session(token)
+                username = username or f"<session of patient {patient_id}>"
+            else:
+                patient_id, fernet = db.validate_user(username, password)
 
-            except FaviconRequestException:
-                connection.shutdown(socket.SHUT_RDWR)  # ignore favicon.ico request from browser
-                continue
+    except db.SecurityError as ex:
+        try:
+            if (path != '/patient' or req_method != 'POST' or headers['entry_type'] != 'patient' or not username
+                    or not password):
+                error_response(ex, connection, response_dict['access_denied'], keep_alive)
+                return
+        except KeyError as ex:
+            error_response(ex, connection, response_dict['missing_entry_type'], keep_alive)
+            return
+
+        else:
+            try:
+                compact = query_flag(query_dict, 'compact')
+            except ValueError as ex:
+                error_response(ex, connection, response_dict['bad_query'], keep_alive)
+                return
+            try:
+                entry_dict = json.loads(body_raw.strip())
+                last_name = entry_dict['last_name']
+                first_name = entry_dict['first_name']
+                date_of_birth = {unit: int(value.strip()) for unit, value in
+                                 zip(["year", "month", "day"], entry_dict['date_of_birth'].split('/'))}
+
+                registration = db.prepare_registration(username, password)  # the KDF runs before the lock is taken
+                with db.atomic():  # undo changes to database if something went wrong in insert_patient()
+                    cred_id, fernet = db.register(registration)
+                    patient_id = db.insert_patient(last_name, first_name, credentials_id=cred_id, fernet=fernet,
+                                                   **date_of_birth)  # commits changes to db when the block ends
+
+            except KeyError as ex:
+                error_response(ex, connection, response_dict['missing_entry_value'], keep_alive)
+                return
+            except ValueError as ex:
+                error_response(ex, connection, response_dict['bad_entry_value'], keep_alive)
+                return
+            except sqlite3.IntegrityError as ex:
+                error_response(ex, connection, response_dict['already_registered'], keep_alive)
+                return
+            except sqlite3.Error as ex:  # e.g. 'database is locked', the account was not created
+                error_response(ex, connection, response_dict['database_unavailable'], keep_alive)
+                return
+
+            if compact:
+                resp = json.dumps({'entry_type': 'patient', 'id': patient_id}) + "\n"
+                send_response(connection, response_dict['ok_json'], resp, keep_alive)
+            else:
+                resp = f"User {username}:{password} successfully registered\n"
+                resp += f'Entry: {headers["entry_type"]}\n' + body_raw + "\nsuccessfully added to database!\n"
+                send_response(connection, response_dict['ok_plain'], resp, keep_alive)
+            success_message(
+                f"Registered new user: {username}\nadded new patient {last_name} {first_name} to database.")
+            return
+
+    if path == '/login':
+        if req_method != 'POST':
+            error_response(ValueError(f"Unsupported method {req_method} for {path}"),
+                           connection, response_dict['bad_request_path'], keep_alive)
+            return
+
+        response = response_dict['ok_json']
+        resp = json.dumps({'token': enc.issue_session_token(patient_id, fernet),
+                           'token_type': 'Bearer',
+                           'expires_in': enc.SESSION_TTL}, indent=4) + "\n"
+        message = f"Issued session token for user {username}"
+
+    elif path == '/patient/stats':
+        if req_method != 'GET':
+            error_response(ValueError(f"Unsupported method {req_method} for {path}"),
+                           connection, response_dict['bad_request_path'], keep_alive)
+            return
+        try:
+            stats_query = parse_stats_query(query_dict)
+            compact = query_flag(query_dict, 'compact')
+            stats = db.get_stats(patient_id, **stats_query)
+        except ValueError as ex:
+            error_response(ex, connection, response_dict['bad_query'], keep_alive)
+            return
+
+        response = response_dict['ok_json']
+        resp = (json.dumps(stats, separators=(',', ':')) if compact else json.dumps(stats, indent=4)) + "\n"
+        message = f"Computed statistics for user {username}"
+
+    elif req_method == 'GET':
+        try:
+            history_query = parse_history_query(query_dict)
+            stream = query_flag(query_dict, 'stream')
+        except ValueError as ex:
+            error_response(ex, connection, response_dict['bad_query'], keep_alive)
+            return
+
+        if stream:  # rows are encoded and sent while they are read, the response is never held in memory as a whole
+            chunks = db.iter_get(patient_id, fernet, **history_query)
+            send_chunked(connection, response_dict['ok_json'], itertools.chain(chunks, ["\n"]), keep_alive)
+            success_message(f"Streamed data for user {username} from database")
+            return
+
+        def read_patient_data():
+            patient_data = db.get(patient_id, fernet, **history_query)
+            return None if patient_data is None else (patient_data + "\n").encode()
+
+        cached = db.response_cache.get(patient_id, json.dumps(history_query, sort_keys=True, default=str),
+                                       read_patient_data)
+        if cached is None:
+            error_response(db.SecurityError(f"Patient {patient_id} not in register!"),
+                           connection, response_dict['access_denied'], keep_alive)
+            return
+
+        resp, etag = cached
+        validators = b'\r\nETag: ' + etag.encode() + b'\r\nCache-Control: private, no-cache'
+        if etag_matches(headers.get('if-none-match'), etag):
+            send_response(connection, response_dict['not_modified'], keep_alive=keep_alive, extra_headers=validators)
+            success_message(f"Data of user {username} not modified")
+        else:
+            send_response(connection, response_dict['ok_json'], resp, keep_alive, validators)
+            success_message(f"Retrieved data for user {username} from database")
+        return
+
+    else:  # do stuff for 'POST' request method
+        try:
+            entry_type = headers['entry_type'].lower()
+        except KeyError as ex:
+            error_response(ex, connection, response_dict['missing_entry_type'], keep_alive)
+            return
+        try:
+            compact = query_flag(query_dict, 'compact')  # acknowledge with row ids instead of echoing the entries
+        except ValueError as ex:
+            error_response(ex, connection, response_dict['bad_query'], keep_alive)
+            return
+
+        if entry_type == 'pressure' or entry_type == 'temperature':
+            try:
+                entry_dict = json.loads(body_raw.strip())
+                measurement = parse_measurement(entry_type, entry_dict)
 
-            except InvalidRequestPathException as ex:
-                error_shutdown_connection(ex, connection, response_dict['bad_request_path'])
-                continue
+                if entry_type == 'pressure':
+                    row_id = db.insert_pressure(patient_id=patient_id, fernet=fernet, **measurement)
 
-            except UnsupportedMethodException as ex:
-                error_shutdown_connection(ex, connection, response_dict['bad_request_method'])
-                continue
+                elif entry_type == 'temperature':
+                    row_id = db.insert_temperature(patient_id=patient_id, fernet=fernet, **measurement)
 
-            except HTTPRequestException as ex:
-                error_shutdown_connection(ex, connection, response_dict['bad_request'])
-                continue
+                message = f"Inserted new: {entry_type} entry for user: {username}"
 
-            username = query_dict['username']
-            password = query_dict['password']
+            except KeyError as ex:
+                error_response(ex, connection, response_dict['missing_entry_value'], keep_alive)
+                return
 
-            try:
+            except (ValueError, TypeError, AttributeError) as ex:  # e.g. a JSON list or a number instead of a dict
+                error_response(ex, connection, response_dict['bad_entry_value'], keep_alive)
+                return
 
-                patient_id, fernet = db.validate_user(username, password)
+            if compact:
+                response = response_dict['ok_json']
+                resp = json.dumps({'entry_type': entry_type, 'id': row_id}) + "\n"
+            else:
+                response = response_dict['ok_plain']
+                resp = f'Entry: {entry_type}\n' + body_raw + "\nsuccessfully added to database!\n"
 
-            except db.SecurityError as ex:
+        elif entry_type == 'pressure_batch' or entry_type == 'temperature_batch':
+            try:
+                entries = parse_batch(body_raw)
+            except ValueError as ex:
+                error_response(ex, connection, response_dict['bad_entry_value'], keep_alive)
+                return
+
+            measurement_type = entry_type[:-len('_batch')]
+            results = [None] * len(entries)
+            measurements = []  # (index in entries, insert_* keyword arguments)
+            for index, entry_dict in enumerate(entries):
                 try:
-                    if req_method != 'POST' or headers['entry_type'] != 'patient' or not username or not password:
-                        error_shutdown_connection(ex, connection, response_dict['access_denied'])
-                        continue
+                    measurements.append((index, parse_measurement(measurement_type, entry_dict)))
                 except KeyError as ex:
-                    error_shutdown_connection(ex, connection, response_dict['missing_entry_type'])
-                    continue
-
-                else:
+                    results[index] = f"Missing entry value: {ex}"
+                except (ValueError, TypeError, AttributeError) as ex:
+                    results[index] = f"Bad entry value: {ex}"
+
+            insert_batch = db.insert_pressure_batch if measurement_type == 'pressure' else db.insert_temperature_batch
+            inserted_results = insert_batch([kwargs for index, kwargs in measurements], patient_id=patient_id,
+                                            fernet=fernet)
+            for (index, kwargs), result in zip(measurements, inserted_results):
+                results[index] = result  # row id or error message
+
+            inserted = sum(isinstance(result, int) for result in results)
+            response = response_dict['ok_json']
+            if compact:
+                resp = json.dumps({'entry_type': entry_type,
+                                   'inserted': inserted,
+                                   'rejected': len(results) - inserted,
+                                   'ids': [result if isinstance(result, int) else None for result in results],
+                                   'errors': {index: result for index, result in enumerate(results)
+                                              if not isinstance(result, int)}}, separators=(',', ':')) + "\n"
+            else:
+                resp = json.dumps({'entry_type': entry_type,
+                                   'inserted': inserted,
+                                   'rejected': len(results) - inserted,
+                                   'results': [{'index': index, 'status': 'inserted', 'id': result}
+                                               if isinstance(result, int) else
+                                               {'index': index, 'status': 'rejected', 'error': result}
+                                               for index, result in enumerate(results)]}, indent=4) + "\n"
+            message = f"Inserted {inserted} of {len(results)} {measurement_type} entries for user: {username}"
+
+        elif entry_type == 'password':
+            if token is not None:  # a session token doesn't prove the knowledge of the current password
+                error_response(db.SecurityError("Password change needs username and password"),
+                               connection, response_dict['access_denied'], keep_alive)
+                return
+            try:
+                new_password = json.loads(body_raw.strip())['new_password']
+                db.change_password(username, password, new_password)
+            except KeyError as ex:
+                error_response(ex, connection, response_dict['missing_entry_value'], keep_alive)
+                return
+            except (ValueError, TypeError, AttributeError) as ex:
+                error_response(ex, connection, response_dict['bad_entry_value'], keep_alive)
+                return
+
+            response = response_dict['ok_plain']
+            resp = f"Password of user {username} successfully changed\n"
+            message = f"Changed password of user: {username}"
+
+        elif entry_type == 'patient':
+            error_response(ValueError(f"User {username} already registered!"),
+                           connection, response_dict['already_registered'], keep_alive)
+            return
+
+        else:
+            error_response(ValueError("Invalid entry_type value!"),
+                           connection, response_dict['bad_entry_type'], keep_alive)
+            return
+
+    send_response(connection, response, resp, keep_alive)
+    success_message(message)
+
+
+def serve_connection(reader: RequestReader, address, monitor):
+    """Worker entry point, an unexpected error ends only this connection and not the whole server."""
+    keep_alive = False
+    try:
+        keep_alive = handle_connection(reader, address)
+    except Exception:
+        log.exception('Error while handling connection', extra={'client': f'{address[0]}:{address[1]}'})
+    finally:
+        if keep_alive:
+            monitor.park(reader, address)
+        else:
+            reader.connection.close()
+
+
+class ConnectionMonitor:
+    """
+    Watches (selectors) the server socket and the connections waiting for their next request, in the accepting
+    thread, so that an idle keep-alive connection doesn't hold a worker thread. wait() returns connections with data
+    to read, connections idle longer than KEEP_ALIVE_TIMEOUT are closed. Workers hand connections back with park().
+    """
+
+    def __init__(self, serverSocket):
+        self.server_socket = serverSocket
+        self.server_socket.setblocking(False)  # with --processes another process may accept the connection first
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.server_socket, selectors.EVENT_READ)
+        self._wakeup, self._notify = socket.socketpair()  # park() interrupts select()
+        self._wakeup.setblocking(False)
+        self._notify.setblocking(False)
+        self.selector.register(self._wakeup, selectors.EVENT_READ)
+        self._parked = queue.SimpleQueue()  # (reader, address) handed back by workers
+        self._deadlines = {}  # watched reader -> time (monotonic) its connection is closed at
+
+    def park(self, reader: RequestReader, address):
+        """Watches the connection (from any thread) until the client sends its next request."""
+        self._parked.put((reader, address))
+        try:
+            self._notify.send(b'\0')
+        except OSError:  # the socket buffer is full of wake-ups already
+            pass
+
+    def _watch(self, reader: RequestReader, address):
+        self.selector.register(reader.connection, selectors.EVENT_READ, (reader, address))
+        self._deadlines[reader] = time.monotonic() + KEEP_ALIVE_TIMEOUT
+
+    def _forget(self, reader: RequestReader):
+        self.selector.unregister(reader.connection)
+        del self._deadlines[reader]
+
+    def wait(self) -> list:
+        """[(reader, address)] of new connections and idle ones with a request coming, blocks until there are some."""
+        ready = []
+        while not ready:
+            timeout = max(min(self._deadlines.values()) - time.monotonic(), 0) if self._deadlines else None
+            for key, _ in self.selector.select(timeout):
+                if key.fileobj is self.server_socket:
                     try:
-                        entry_dict = json.loads(body_raw.strip())
-                        last_name = entry_dict['last_name']
-                        first_name = entry_dict['first_name']
-                        date_of_birth = {unit: int(value.strip()) for unit, value in
-                                         zip(["year", "month", "day"], entry_dict['date_of_birth'].split('/'))}
-
-                        cred_id, fernet = db.register(username, password)
-                        db.insert_patient(last_name, first_name, credentials_id=cred_id, fernet=fernet,
-                                          **date_of_birth)  # if successful then commits changes to db
-
-                    except KeyError as ex:
-                        error_shutdown_connection(ex, connection, response_dict['missing_entry_value'])
+                        connection, address = self.server_socket.accept()
+                    except BlockingIOError:
                         continue
-                    except ValueError as ex:
-                        error_shutdown_connection(ex, connection, response_dict['bad_entry_value'])
-                        continue
-                    except sqlite3.Error as ex:
-                        error_shutdown_connection(ex, connection, response_dict['already_registered'])
-                        conn.rollback()  # undo changes to database if something went wrong in insert_patient()
-                        continue
-
-                    resp = response_dict['ok_plain']
-                    resp += "\r\n"
-                    resp += f"User {username}:{password} successfully registered\n"
-                    resp += f'Entry: {headers["entry_type"]}\n' + body_raw + "\nsuccessfully added to database!\n"
-                    connection.sendall(resp.encode())
-                    connection.shutdown(socket.SHUT_WR)
-                    success_message(
-                        f"Registered new user: {username}\nadded new patient {last_name} {first_name} to database.")
-                    continue
-
-            if req_method == 'GET':
-                patient_data = db.get(patient_id, fernet)
-                resp = response_dict['ok_json']
-                resp += '\r\n'
-                resp += patient_data + "\n"
-                message = f"Retrieved data for user {username} from database"
-
-            else:  # do stuff for 'POST' request method
-                try:
-                    entry_type = headers['entry_type'].lower()
-                except KeyError as ex:
-                    error_shutdown_connection(ex, connection, response_dict['missing_entry_type'])
-                    continue
-
-                entry_dict = json.loads(body_raw.strip())
-                if entry_type == 'pressure' or entry_type == 'temperature':
+                    self._watch(RequestReader(connection), address)
+                elif key.fileobj is self._wakeup:
                     try:
-                        timestamp = {unit: int(value.strip()) for unit, value in
-                                     zip(["year", "month", "day", "hour", "minute"],
-                                         entry_dict['acquisition'].split('/'))}
-
-                        if entry_type == 'pressure':
-                            systolic = float(entry_dict['systolic'])
-                            diastolic = float(entry_dict['diastolic'])
-                            db.insert_pressure(systolic, diastolic, patient_id=patient_id, fernet=fernet, **timestamp)
+                        while self._wakeup.recv(RECV_SIZE):
+                            pass
+                    except BlockingIOError:
+                        pass
+                else:
+                    self._forget(key.data[0])
+                    ready.append(key.data)
+            while not self._parked.empty():
+                self._watch(*self._parked.get())
+            now = time.monotonic()
+            for reader in [reader for reader, deadline in self._deadlines.items() if deadline <= now]:
+                self._forget(reader)
+                reader.connection.close()
+        return ready
+
+    def close(self):
+        """Closes the watched connections, the server socket is left to the caller."""
+        while not self._parked.empty():
+            self._parked.get()[0].connection.close()
+        for reader in list(self._deadlines):
+            self._forget(reader)
+            reader.connection.close()
+        self.selector.close()
+        self._wakeup.close()
+        self._notify.close()
+
+
+def make_server_socket(address, port, backlog, reuse_port=False):
+    serverSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    serverSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        serverSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    try:
+        serverSocket.bind((address, port))
+        serverSocket.listen(backlog)
+    except OSError:
+        serverSocket.close()
+        raise
+    return serverSocket
+
+
+def serve(serverSocket, workers=WORKERS):
+    """Serves requests with a pool of `workers` threads (workers=0 handles them one by one in the accepting thread)."""
+    listener = logs.start(LOG_LEVEL, LOG_SAMPLE_RATE)  # per process, the listener thread doesn't survive fork()
+    if hasattr(signal, 'SIGUSR1'):  # toggle in a thread, the handler may interrupt this thread inside profiling.add()
+        signal.signal(signal.SIGUSR1, lambda signum, frame: threading.Thread(target=profiling.toggle).start())
+    conn = db.connect(db.MEDICAL_REGISTRY, SQLITE_PRAGMAS, readers=max(workers, 1))
+    db.enable_group_commit(GROUP_COMMIT_LATENCY, GROUP_COMMIT_BATCH)
+    log.info('Serving', extra={'pid': os.getpid(), 'workers': workers, 'sqlite_pragmas': db.active_pragmas(conn)})
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='worker') if workers > 0 else None
+    monitor = ConnectionMonitor(serverSocket)
+    try:
+        while True:
+            for reader, client_address in monitor.wait():
+                if executor is not None:
+                    executor.submit(serve_connection, reader, client_address, monitor)
+                else:
+                    serve_connection(reader, client_address, monitor)
 
-                        elif entry_type == 'temperature':
-                            value = float(entry_dict['value'])
-                            db.insert_temperature(value, patient_id=patient_id, fernet=fernet, **timestamp)
+    except KeyboardInterrupt:
+        log.info('Shutting down')
 
-                        message = f"Inserted new: {entry_type} entry for user: {username}"
+    except Exception:
+        log.exception('Server error')
 
-                    except KeyError as ex:
-                        error_shutdown_connection(ex, connection, response_dict['missing_entry_value'])
-                        continue
+    finally:
+        serverSocket.close()
+        if executor is not None:
+            executor.shutdown(wait=True)
+        monitor.close()  # after the workers, they may still hand connections back
+        conn.close()
+        profiling.dump()
+        logs.stop(listener)
 
-                    except ValueError as ex:
-                        error_shutdown_connection(ex, connection, response_dict['bad_entry_value'])
-                        continue
 
-                    resp = response_dict['ok_plain']
-                    resp += '\r\n'
-                    resp += f'Entry: {entry_type}\n' + body_raw + "\nsuccessfully added to database!\n"
+def create_server(address=SERVER_ADDRESS, port=SERVER_PORT, workers=WORKERS, backlog=BACKLOG):
+    serve(make_server_socket(address, port, backlog), workers)
 
-                elif entry_type == 'patient':
-                    error_shutdown_connection(ValueError(f"User {username} already registered!"),
-                                              connection, response_dict['already_registered'])
-                    continue
 
-                else:
-                    error_shutdown_connection(ValueError("Invalid entry_type value!"),
-                                              connection, response_dict['bad_entry_type'])
-                    continue
+def run_worker_process(serverSocket, workers):
+    """Body of a pre-forked child, SIGTERM finishes in-flight requests like Ctrl+C does."""
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    try:
+        serve(serverSocket, workers)
+    finally:
+        os._exit(0)
+
+
+def create_prefork_server(address=SERVER_ADDRESS, port=SERVER_PORT, processes=PROCESSES, workers=WORKERS,
+                          backlog=BACKLOG):
+    """
+    Starts `processes` worker processes, each with its own database connection and thread pool, sharing one port.
+    With SO_REUSEPORT every worker has its own listening socket and the kernel balances connections between them,
+    otherwise the workers accept() on a socket inherited from this (parent) process.
+    Workers that die are respawned, SIGTERM/SIGINT stops all of them gracefully.
+    """
+    reuse_port = hasattr(socket, 'SO_REUSEPORT')
+    shared_socket = None if reuse_port else make_server_socket(address, port, backlog)
+    children = {}  # pid -> worker slot
+    stopping = False
+
+    def spawn(slot):
+        serverSocket = make_server_socket(address, port, backlog, reuse_port=True) if reuse_port else shared_socket
+        pid = os.fork()
+        if pid == 0:
+            run_worker_process(serverSocket, workers)
+        if reuse_port:
+            serverSocket.close()  # the child owns its listening socket
+        children[pid] = (slot, time.monotonic())
+        print(f"Started worker {slot} (pid {pid})")
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
 
-            connection.sendall(resp.encode())
-            connection.shutdown(socket.SHUT_WR)
-            success_message(message)
+    def forward(signum, frame):
+        for pid in children:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, forward)  # profiling toggle of the workers
+    try:
+        for slot in range(processes):
+            spawn(slot)
 
-    except KeyboardInterrupt:
-        print("\nShutting down...\n")
+        while children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            except InterruptedError:
+                continue
 
-    except Exception:
-        print("Error:\n")
-        traceback.print_exc()
-        print("Error:\n")
+            slot, started = children.pop(pid, (None, None))
+            if slot is None or stopping:
+                continue
+            print(f"Worker {slot} (pid {pid}) exited with status {os.waitstatus_to_exitcode(status)}, respawning",
+                  file=sys.stderr)
+            if time.monotonic() - started < RESPAWN_DELAY:
+                time.sleep(RESPAWN_DELAY)  # don't spin if a worker keeps dying right after start
+            if not stopping:
+                spawn(slot)
 
     finally:
-        serverSocket.close()
-        conn.close()
+        if shared_socket is not None:
+            shared_socket.close()
+        print("\nShutting down...\n")
 
 
 if __name__ == '__main__':
-    print(f"Access http://{SERVER_ADDRESS}:{SERVER_PORT}")
-    create_server()
+    arg_parser = argparse.ArgumentParser(description='REST API server of the medical registry')
+    arg_parser.add_argument('--address', default=SERVER_ADDRESS)
+    arg_parser.add_argument('--port', type=int, default=SERVER_PORT)
+    arg_parser.add_argument('--processes', type=int, default=PROCESSES,
+                            help='number of pre-forked worker processes, 0 serves from this process only')
+    arg_parser.add_argument('--workers', type=int, default=WORKERS,
+                            help='number of worker threads (per process), 0 handles requests sequentially')
+    arg_parser.add_argument('--backlog', type=int, default=BACKLOG, help='listen() backlog of the server socket')
+    arg_parser.add_argument('--max-header-size', type=int, default=MAX_HEADER_SIZE,
+                            help='limit (bytes) of the request line and headers')
+    arg_parser.add_argument('--max-body-size', type=int, default=MAX_BODY_SIZE, help='limit (bytes) of the request body')
+    arg_parser.add_argument('--keep-alive-timeout', type=float, default=KEEP_ALIVE_TIMEOUT,
+                            help='seconds an idle persistent connection is kept open')
+    arg_parser.add_argument('--max-keep-alive-requests', type=int, default=MAX_KEEP_ALIVE_REQUESTS,
+                            help='requests served on one connection before it is closed')
+    arg_parser.add_argument('--group-commit-ms', type=float, default=GROUP_COMMIT_LATENCY * 1000,
+                            help='max. time (ms) a write waits to be committed together with others, 0 disables')
+    arg_parser.add_argument('--group-commit-batch', type=int, default=GROUP_COMMIT_BATCH,
+                            help='number of writes committed together without waiting for --group-commit-ms')
+    arg_parser.add_argument('--session-ttl', type=int, default=enc.SESSION_TTL,
+                            help='seconds a session token issued by POST /login stays valid')
+    arg_parser.add_argument('--slow-request-ms', type=float, default=metrics.SLOW_REQUEST_THRESHOLD * 1000,
+                            help='log requests taking at least this long with their phase timings, 0 disables')
+    arg_parser.add_argument('--log-level', default=logging.getLevelName(LOG_LEVEL),
+                            choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], help='lowest level of logged records')
+    arg_parser.add_argument('--log-sample', type=float, default=LOG_SAMPLE_RATE,
+                            help='fraction of requests whose records below WARNING are logged')
+    arg_parser.add_argument('--profile', action='store_true',
+                            help='profile sampled requests from the start, SIGUSR1 toggles profiling at any time')
+    arg_parser.add_argument('--profile-sample', type=float, default=profiling.SAMPLE_RATE,
+                            help='fraction of requests profiled while profiling is enabled')
+    arg_parser.add_argument('--profile-dir', default=profiling.PROFILE_DIR, help='directory of written .pstats files')
+    arg_parser.add_argument('--profile-interval', type=float, default=profiling.INTERVAL,
+                            help='seconds of aggregated profiles written to one file')
+    arg_parser.add_argument('--response-cache-mb', type=float, default=db.RESPONSE_CACHE_SIZE / 2 ** 20,
+                            help='memory for cached GET /patient responses, 0 disables the cache '
+                                 '(always disabled with --processes)')
+    arg_parser.add_argument('--fernet-cache-size', type=int, default=enc.fernet_cache.max_entries,
+                            help='keys derived from passwords kept in memory, 0 derives the key on every login')
+    arg_parser.add_argument('--seed-demo', action='store_true',
+                            help='fill an empty database with the demo patients of database.fake_fill_db()')
+    arg_parser.add_argument('--kdf-config', default=enc.KDF_CONFIG_FILE,
+                            help='KDF parameters of newly wrapped keys, written by `python encryption.py --calibrate`')
+    arg_parser.add_argument('--pragma', action='append', default=[], metavar='NAME=VALUE',
+                            help='override a SQLite pragma of database.CONNECTION_PROFILE, can be repeated')
+    args = arg_parser.parse_args()
+    MAX_HEADER_SIZE = args.max_header_size
+    MAX_BODY_SIZE = args.max_body_size
+    KEEP_ALIVE_TIMEOUT = args.keep_alive_timeout
+    MAX_KEEP_ALIVE_REQUESTS = args.max_keep_alive_requests
+    GROUP_COMMIT_LATENCY = args.group_commit_ms / 1000
+    GROUP_COMMIT_BATCH = args.group_commit_batch
+    SQLITE_PRAGMAS = dict(pragma.split('=', 1) for pragma in args.pragma)
+    LOG_LEVEL = logging.getLevelName(args.log_level)
+    LOG_SAMPLE_RATE = args.log_sample
+    enc.SESSION_TTL = args.session_ttl
+    metrics.SLOW_REQUEST_THRESHOLD = args.slow_request_ms / 1000
+    profiling.enabled = args.profile
+    profiling.SAMPLE_RATE = args.profile_sample
+    profiling.PROFILE_DIR = os.path.abspath(args.profile_dir)
+    profiling.INTERVAL = args.profile_interval
+    # a worker process isn't told about writes of the others, its cache could serve outdated responses
+    db.response_cache.max_bytes = int(args.response_cache_mb * 2 ** 20) if args.processes <= 0 else 0
+    enc.fernet_cache.max_entries = args.fernet_cache_size
+    enc.set_kdf_config(args.kdf_config)
+    print(f"KDF of new keys: {enc.encode_kdf_params(enc.kdf_params())}")
+    db.initialize(db.MEDICAL_REGISTRY, seed_demo=args.seed_demo)  # once, before worker processes are forked
+
+    print(f"Access http://{args.address}:{args.port}")
+    if args.processes > 0:
+        create_prefork_server(args.address, args.port, args.processes, args.workers, args.backlog)
+    else:
+        create_server(args.address, args.port, args.workers, args.backlog)